@@ -0,0 +1,119 @@
+'''
+photometry.py. Visualize the photometric output of a Wavefront obj. model.
+Copyright (C) 2020  Drew Allen McNeely
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import numpy as np
+
+from geometry import IndexedIcoSphere, as_vectors
+
+class BakedScatter:
+    """total_scatter of a model tabulated on the vertices of an icosphere.
+
+    Queries are answered by barycentric interpolation inside the face that
+    contains the direction, so their cost does not depend on the number of
+    facets. max_error and rms_error are measured at bake time against the
+    exact model at every face barycenter, the points furthest from the
+    tabulated vertices.
+    """
+    def __init__(self, sphere, values, max_error=np.nan, rms_error=np.nan):
+        self.sphere = sphere
+        self.values = np.asarray(values, dtype=float)
+        self.max_error = float(max_error)
+        self.rms_error = float(rms_error)
+
+    @classmethod
+    def bake(cls, model, level=5):
+        sphere = IndexedIcoSphere.icosahedron().divided(level)
+        baked = cls(sphere, model.total_scatter_many(sphere.vertices))
+        error = baked(sphere.barycenters) - model.total_scatter_many(sphere.barycenters)
+        baked.max_error = np.abs(error).max()
+        baked.rms_error = np.sqrt(np.mean(error**2))
+        return baked
+
+    def __call__(self, viewer_directions):
+        faces, w = self.sphere.locate(viewer_directions)
+        corners = self.sphere.faces[faces]
+        return np.einsum("ni,ni->n", w, self.values[corners])
+
+    total_scatter_many = __call__
+
+    def total_scatter(self, viewer_direction):
+        return self(as_vectors(viewer_direction))[0]
+
+    def save(self, path):
+        np.savez(path, vertices=self.sphere.vertices, faces=self.sphere.faces,
+                values=self.values, max_error=self.max_error, rms_error=self.rms_error)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            sphere = IndexedIcoSphere(f["vertices"], f["faces"])
+            return cls(sphere, f["values"], f["max_error"], f["rms_error"])
+
+class BakedBistaticScatter(BakedScatter):
+    """scatter of a model tabulated on a light x viewer grid of icosphere vertices.
+
+    values[i, j] is the scatter for light vertex i and viewer vertex j, and
+    queries interpolate over the 3x3 corners of the light and viewer faces.
+    The table grows as the square of the vertex count, so levels of 3 or 4
+    are the practical range. Errors are measured at check_pairs random
+    pairs of face barycenters.
+    """
+    @classmethod
+    def bake(cls, model, level=3, check_pairs=4096, seed=0):
+        sphere = IndexedIcoSphere.icosahedron().divided(level)
+        vs = sphere.vertices
+        baked = cls(sphere, model.scatter_many(vs, vs))
+
+        rng = np.random.default_rng(seed)
+        bary = sphere.barycenters
+        L = bary[rng.integers(len(bary), size=check_pairs)]
+        V = bary[rng.integers(len(bary), size=check_pairs)]
+        error = baked(L, V) - model.scatter_many(L, V, paired=True)
+        baked.max_error = np.abs(error).max()
+        baked.rms_error = np.sqrt(np.mean(error**2))
+        return baked
+
+    def __call__(self, light_directions, viewer_directions):
+        """Paired scatter for (K,3) light and viewer directions."""
+        lf, lw = self.sphere.locate(light_directions)
+        vf, vw = self.sphere.locate(viewer_directions)
+        li = self.sphere.faces[lf]
+        vi = self.sphere.faces[vf]
+        corners = self.values[li[:, :, None], vi[:, None, :]]
+        return np.einsum("ni,nij,nj->n", lw, corners, vw)
+
+    def scatter_many(self, light_directions, viewer_directions, paired=True):
+        if not paired:
+            Ls = as_vectors(light_directions)
+            Vs = as_vectors(viewer_directions)
+            L = np.repeat(Ls, len(Vs), axis=0)
+            V = np.tile(Vs, (len(Ls), 1))
+            return self(L, V).reshape(len(Ls), len(Vs))
+        return self(light_directions, viewer_directions)
+
+    def total_scatter_many(self, viewer_directions):
+        return self(viewer_directions, viewer_directions)
+
+    def scatter(self, light_direction, viewer_direction):
+        return self(as_vectors(light_direction), as_vectors(viewer_direction))[0]
+
+def bake(model, level=None, bistatic=False):
+    """Baked lookup table for a model with total_scatter_many/scatter_many."""
+    if bistatic: return BakedBistaticScatter.bake(model, level or 3)
+    else: return BakedScatter.bake(model, level or 5)
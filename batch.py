@@ -0,0 +1,231 @@
+'''
+photometry.py. Visualize the photometric output of a Wavefront obj. model.
+Copyright (C) 2020  Drew Allen McNeely
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import argparse
+import glob
+import hashlib
+import json
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy
+from pathlib import Path
+
+from cache import cache_key
+from wavefront import material_libraries
+import export
+
+# Batch evaluation of many models and material presets.
+#
+# Inputs are .obj files, directories of them, glob patterns, or manifests
+# (.json lists of paths or {"path": ..., "preset": ...} objects, or text
+# files with one path per line). Every model runs once per preset; a job
+# writes the sphere and its values as <name>.npz or <name>.parquet (see
+# export), optionally <name>.html, and <name>.json recording the key of
+# its inputs, so that rerunning skips jobs whose outputs are current.
+
+description = "Evaluate many Wavefront .obj models and material presets in parallel."
+
+def apply_preset(model, preset):
+    """FacetArray with every material overridden by the preset.
+
+    diffuse_fraction, diffuse_law and specular_law replace those of every
+    facet; other keys are set on copies of each MaterialProperty.
+    """
+    from models import FacetArray
+    preset = dict(preset)
+    fraction = preset.pop("diffuse_fraction", None)
+    diffuse = preset.pop("diffuse_law", None)
+    specular = preset.pop("specular_law", None)
+    materials = [copy(m) for m in model.materials]
+    for m in materials: m.__dict__.update(preset)
+    out = FacetArray(model.areas, model.normals,
+            model.diffuse_fractions if fraction is None else fraction,
+            materials, model.material_index,
+            [(diffuse or d, specular or s) for d, s in model.laws], model.law_index,
+            normalize=False)
+    out.chunk_elements = model.chunk_elements
+    out.shadowing = model.shadowing
+    return out
+
+def read_manifest(path):
+    path = Path(path)
+    if path.suffix == ".json":
+        with open(path) as f:
+            entries = json.load(f)
+    else:
+        with open(path) as f:
+            entries = [l.strip() for l in f if l.strip() and not l.lstrip().startswith("#")]
+    for e in entries:
+        if isinstance(e, str): e = {"path": e}
+        yield dict(e, path=str(path.parent / e["path"]))
+
+def expand_inputs(inputs):
+    """{"path": ...} entries for .obj files, directories, globs and manifests."""
+    for i in inputs:
+        p = Path(i)
+        if p.is_dir():
+            for obj in sorted(p.glob("*.obj")): yield {"path": str(obj)}
+        elif any(c in i for c in "*?["):
+            for obj in sorted(glob.glob(i, recursive=True)): yield {"path": obj}
+        elif p.suffix == ".obj":
+            yield {"path": i}
+        else:
+            yield from read_manifest(p)
+
+def plan_jobs(entries, presets, settings):
+    """One job per distinct entry and preset, each with a unique output name."""
+    jobs = []
+    names = set()
+    seen = set()
+    for e in entries:
+        for preset in ([e["preset"]] if "preset" in e else list(presets) or [None]):
+            if (Path(e["path"]).resolve(), preset) in seen: continue
+            seen.add((Path(e["path"]).resolve(), preset))
+            name = Path(e["path"]).stem + ("-" + preset if preset else "")
+            if name in names:
+                name += "-" + hashlib.blake2b(e["path"].encode(), digest_size=4).hexdigest()
+            names.add(name)
+            jobs.append(dict(settings, name=name, path=e["path"], preset=preset,
+                    material=presets.get(preset, {}) if preset else {}))
+    return jobs
+
+def outputs(job):
+    out = Path(job["output"])
+    files = [out / (job["name"] + "." + job["format"]), out / (job["name"] + ".json")]
+    if job["render"]: files.append(out / (job["name"] + ".html"))
+    return files
+
+def job_key(job):
+    return cache_key(job["path"], material_libraries(job["path"]),
+            preset=job["material"], level=job["level"],
+            shadowing=job["shadowing"], render=job["render"],
+            format=job["format"], float32=job["float32"])
+
+def is_current(job):
+    """Whether every output of the job exists and matches its inputs."""
+    files = outputs(job)
+    if not all(f.exists() for f in files): return False
+    try:
+        with open(files[1]) as f:
+            return json.load(f)["key"] == job_key(job)
+    except (OSError, ValueError, KeyError):
+        return False
+
+def run_job(job):
+    """Run one job, returning (name, error) with error None on success."""
+    try:
+        from models import WavefrontModel
+        from visualization import sphere
+
+        start = time.perf_counter()
+        key = job_key(job)
+        model = WavefrontModel.from_path(job["path"], job["shadowing"], cache=job["cache"])
+        if len(model.facet_model) == 0:
+            raise ValueError("%s has no faces" % job["path"])
+        facets = apply_preset(model.facet_model, job["material"])
+        s = sphere(job["level"])
+        values = facets.total_scatter_many(s.barycenters)
+
+        data, record = outputs(job)[:2]
+        export.save(data, s, values, job["float32"])
+        if job["render"]:
+            export.save(data.with_suffix(".html"), s, values)
+        # Written last, so an interrupted job is never taken as current.
+        with open(record, "w") as f:
+            json.dump({"key": key, "path": job["path"], "preset": job["preset"],
+                "level": job["level"], "facets": len(facets),
+                "seconds": time.perf_counter() - start}, f, indent=2)
+        return job["name"], None
+    except Exception:
+        return job["name"], traceback.format_exc(limit=3)
+
+def run(jobs, workers=None):
+    """Run jobs over a process pool, yielding (name, error) as they finish."""
+    if workers == 1:
+        yield from map(run_job, jobs)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(run_job, jobs)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("inputs", nargs="+",
+        help=".obj files, directories, glob patterns or manifest files")
+    parser.add_argument("-o", "--output", default="batch-output",
+        help="directory for the per-job outputs (default: batch-output)")
+    parser.add_argument("-j", "--workers", type=int,
+        help="worker processes (default: one per CPU)")
+    parser.add_argument("--presets",
+        help="JSON file of {name: {material overrides}}; every model runs once per preset")
+    parser.add_argument("--level", type=int, default=4,
+        help="icosphere subdivision level (default: 4)")
+    parser.add_argument("--shadowing", action="store_true", help="model self-shadowing")
+    parser.add_argument("--format", choices=["npz", "parquet"], default="npz",
+        help="numeric output format (default: npz)")
+    parser.add_argument("--float32", action="store_true",
+        help="store coordinates and values in single precision")
+    parser.add_argument("--render", action="store_true", help="also write HTML plots")
+    parser.add_argument("--cache-dir",
+        help="mesh array cache shared by the workers (default: $PHOTOMETRY_CACHE_DIR "
+             "or ~/.cache/photometry)")
+    parser.add_argument("--no-cache", action="store_true", help="parse every mesh afresh")
+    parser.add_argument("--force", action="store_true", help="rerun jobs that are current")
+    args = parser.parse_args(argv)
+
+    presets = {}
+    if args.presets:
+        with open(args.presets) as f:
+            presets = json.load(f)
+    output = Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+    settings = {"output": str(output), "level": args.level, "shadowing": args.shadowing,
+            "format": args.format, "float32": args.float32, "render": args.render, "cache": False if args.no_cache else (args.cache_dir or True)}
+
+    failures = {}
+    try: jobs = plan_jobs(expand_inputs(args.inputs), presets, settings)
+    except (OSError, ValueError, KeyError) as e:
+        parser.error(str(e))
+    pending = []
+    for job in jobs:
+        try:
+            if args.force or not is_current(job): pending.append(job)
+        except OSError as e:
+            failures[job["name"]] = str(e)
+    print("%d jobs, %d current, %d to run" % (len(jobs), len(jobs) - len(pending) - len(failures),
+        len(pending)))
+
+    for name, error in run(pending, args.workers):
+        if error is None:
+            print("done", name)
+        else:
+            print("failed", name, file=sys.stderr)
+            failures[name] = error
+
+    with open(output / "failures.json", "w") as f:
+        json.dump(failures, f, indent=2)
+    if failures:
+        print("%d jobs failed; see %s" % (len(failures), output / "failures.json"), file=sys.stderr)
+        for name, error in failures.items():
+            print("  " + name + ": " + error.strip().splitlines()[-1], file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
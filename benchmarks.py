@@ -0,0 +1,352 @@
+'''
+photometry.py. Visualize the photometric output of a Wavefront obj. model.
+Copyright (C) 2020  Drew Allen McNeely
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+description = """Benchmarks for the hot paths of the photometry pipeline.
+
+Run all benchmarks and write machine-readable results:
+
+    python3 benchmarks.py --output results.json
+
+and compare a later run against them:
+
+    python3 benchmarks.py --output new.json --compare results.json
+
+--check instead runs the equivalence checks, which compare the vectorized
+kernels with the scalar reference implementations they replace.
+
+Each benchmark reports the best wall time over --repeat runs and the peak
+memory traced by tracemalloc during one extra run (NumPy allocations are
+included). Tracing slows Python-heavy code down, so it is never timed.
+"""
+
+import argparse
+import importlib.util
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+from geometry import IcoSphere, IndexedIcoSphere, normalize_rows, vectorized
+
+benchmarks = []
+checks = []
+
+def benchmark(name, quick=True, **params):
+    """Register a benchmark. setup(**params) returns the function to measure;
+    quick=False leaves it out of --quick runs."""
+    def register(setup):
+        benchmarks.append(dict(name=name, setup=setup, params=params, quick=quick))
+        return setup
+    return register
+
+def check(f):
+    """Register an equivalence check. f() returns the largest relative error
+    and the tolerance it must stay within."""
+    checks.append(f)
+    return f
+
+def synthetic_obj(directory, faces):
+    """Write a closed-ish icosphere mesh with about the given face count."""
+    path = Path(directory) / ("sphere-%d.obj" % faces)
+    if path.exists(): return path
+    level = max(0, int(np.ceil(np.log(faces / 20) / np.log(4))))
+    s = IndexedIcoSphere.icosahedron().divided(level)
+    with open(path, "w") as f:
+        np.savetxt(f, s.vertices, fmt="v %.6f %.6f %.6f")
+        np.savetxt(f, s.faces[:faces] + 1, fmt="f %d %d %d")
+    return path
+
+def occluding_spheres(level):
+    """Vertices, faces and normals of two icospheres shadowing each other."""
+    s = IndexedIcoSphere.icosahedron().divided(level)
+    vertices = np.vstack([s.vertices, 0.6 * s.vertices + [1.5, 0, 0]])
+    faces = np.vstack([s.faces, s.faces + len(s.vertices)])
+    tris = vertices[faces]
+    normals = normalize_rows(np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0]))
+    return vertices, faces, normals
+
+def random_facets(n, seed=0):
+    from models import FacetArray
+    rng = np.random.default_rng(seed)
+    return FacetArray(rng.random(n), rng.normal(size=(n, 3)))
+
+def random_directions(n, seed=1):
+    return normalize_rows(np.random.default_rng(seed).normal(size=(n, 3)))
+
+for faces in [10**3, 10**4, 10**5, 10**6]:
+    @benchmark("load_obj_%d" % faces, quick=faces <= 10**5, faces=faces)
+    def setup(faces, workdir):
+        from models import WavefrontModel
+        path = synthetic_obj(workdir, faces)
+        return lambda: WavefrontModel.from_path(path)
+
+for level in range(1, 8):
+    @benchmark("icosphere_divided_%d" % level, quick=level <= 5, level=level)
+    def setup(level, workdir):
+        return lambda: IcoSphere.icosahedron().divided(level)
+
+    @benchmark("indexed_icosphere_divided_%d" % level, level=level)
+    def setup(level, workdir):
+        return lambda: IndexedIcoSphere.icosahedron().divided(level)
+
+@benchmark("model_scatter_scalar", facets=1000)
+def setup(facets, workdir):
+    from geometry import SpherePoint
+    from models import Model, Facet
+    m = random_facets(facets)
+    model = Model([Facet(area=a, normal_direction=SpherePoint(n)) for a, n in zip(m.areas, m.normals)])
+    L, V = [SpherePoint(d) for d in random_directions(2)]
+    return lambda: model.scatter(L, V)
+
+@benchmark("facet_array_scatter", facets=100000)
+def setup(facets, workdir):
+    model = random_facets(facets)
+    L, V = random_directions(2)
+    return lambda: model.scatter(L, V)
+
+@benchmark("facet_array_scatter_many_paired", facets=100000, directions=256)
+def setup(facets, directions, workdir):
+    model = random_facets(facets)
+    Ls = random_directions(directions, 1)
+    Vs = random_directions(directions, 2)
+    return lambda: model.scatter_many(Ls, Vs, paired=True)
+
+@benchmark("facet_array_scatter_many_grid", facets=10000, lights=64, viewers=64)
+def setup(facets, lights, viewers, workdir):
+    model = random_facets(facets)
+    Ls = random_directions(lights, 1)
+    Vs = random_directions(viewers, 2)
+    return lambda: model.scatter_many(Ls, Vs)
+
+for level in [4, 5]:
+    @benchmark("shadowing_build_%d" % (40 * 4**level), quick=level <= 4, level=level)
+    def setup(level, workdir):
+        from shadowing import Shadowing
+        mesh = occluding_spheres(level)
+        return lambda: Shadowing(*mesh)
+
+    @benchmark("shadowing_sweep_%d" % (40 * 4**level), quick=level <= 4, level=level,
+            sweep_level=3)
+    def setup(level, sweep_level, workdir):
+        from shadowing import Shadowing
+        shadowing = Shadowing(*occluding_spheres(level))
+        sweep = normalize_rows(IndexedIcoSphere.icosahedron().divided(sweep_level).barycenters)
+        def run():
+            shadowing._cache.clear()
+            shadowing.unoccluded(sweep)
+        return run
+
+@benchmark("icosphere_geojson", level=4)
+def setup(level, workdir):
+    s = IcoSphere.icosahedron().divided(level)
+    return lambda: s.geojson
+
+@benchmark("indexed_icosphere_geojson", level=4)
+def setup(level, workdir):
+    s = IndexedIcoSphere.icosahedron().divided(level)
+    return lambda: s.geojson
+
+@benchmark("plot_function_triangles", facets=10000)
+def setup(facets, workdir):
+    from visualization import plot_function_triangles
+    # visualization imports plotly only when plotting; skip up front instead.
+    if importlib.util.find_spec("plotly") is None: raise ImportError("No module named 'plotly'")
+    model = random_facets(facets)
+    f = vectorized(model.total_scatter_many)
+    filename = str(Path(workdir) / "plot.html")
+    return lambda: plot_function_triangles(f, filename, auto_open=False)
+
+def mixed_model(facets=60, seed=0):
+    """Scalar Model mixing law pairs, materials and diffuse fractions."""
+    from geometry import SpherePoint
+    from materials import MaterialProperty, lambert_diffuse, oren_nayar_diffuse
+    from materials import blinn_phong_specular, phong_specular
+    from models import Model, Facet
+    rng = np.random.default_rng(seed)
+    materials = [MaterialProperty(0.5, 10), MaterialProperty(0.8, 40), MaterialProperty(0.3, 3)]
+    for m in materials:
+        m.sigma, m.E_0 = 0.3, 1
+    laws = [(lambert_diffuse, blinn_phong_specular), (oren_nayar_diffuse, phong_specular)]
+    normals = random_directions(facets, seed)
+    return Model([Facet(area=rng.random(), normal_direction=SpherePoint(n),
+            material_property=materials[rng.integers(len(materials))],
+            diffuse_fraction=rng.choice([0.2, 0.5, 0.9]),
+            diffuse_law=d, specular_law=s)
+        for n, (d, s) in zip(normals, (laws[i] for i in rng.integers(len(laws), size=facets)))])
+
+def scalar_scatter_many(model, Ls, Vs):
+    from geometry import SpherePoint
+    return np.array([[model.scatter(SpherePoint(L), SpherePoint(V)) for V in Vs] for L in Ls])
+
+@check
+def facet_array_matches_model():
+    from models import FacetArray
+    model = mixed_model()
+    Ls, Vs = random_directions(9, 1), random_directions(11, 2)
+    expected = scalar_scatter_many(model, Ls, Vs)
+    errors = []
+    for chunk_elements in [1, 7, 100, 2**21]:
+        array = FacetArray.from_model(model)
+        array.chunk_elements = chunk_elements
+        errors.append(np.abs(array.scatter_many(Ls, Vs) - expected).max())
+        paired = array.scatter_many(Ls, Vs[:9], paired=True)
+        errors.append(np.abs(paired - np.diag(expected[:, :9])).max())
+    return max(errors) / np.abs(expected).max(), 1e-12
+
+@check
+def grouped_facet_array_matches_model():
+    from models import FacetArray
+    model = mixed_model(seed=3)
+    Vs = random_directions(17, 4)
+    expected = np.array([scalar_scatter_many(model, [V], [V])[0, 0] for V in Vs])
+    array, _ = FacetArray.from_model(model).grouped()
+    return np.abs(array.total_scatter_many(Vs) - expected).max() / np.abs(expected).max(), 1e-12
+
+@check
+def float32_facet_array_matches_model():
+    from models import FacetArray
+    model = mixed_model(seed=5)
+    Ls, Vs = random_directions(9, 6), random_directions(11, 7)
+    expected = scalar_scatter_many(model, Ls, Vs)
+    array = FacetArray.from_model(model).astype(np.float32)
+    return np.abs(array.scatter_many(Ls, Vs) - expected).max() / np.abs(expected).max(), 1e-5
+
+@check
+def mtl_specular_scales_with_ks():
+    from materials import Material
+    from models import FacetArray
+    materials = [Material.from_mtl("dim", {"Kd": (0.0, 0.0, 0.0), "Ks": (0.05, 0.05, 0.05)}),
+            Material.from_mtl("bright", {"Kd": (0.0, 0.0, 0.0), "Ks": (1.0, 1.0, 1.0)})]
+    V = random_directions(5, 9)
+    dim, bright = (FacetArray.from_materials(np.ones(1), [[0, 0, 1]], materials, [i])
+            .total_scatter_many(V) for i in range(2))
+    lit = bright > 0
+    return np.abs(dim[lit] / bright[lit] - 0.05).max() / 0.05, 1e-12
+
+@check
+def adaptive_locate_matches_search():
+    sphere = IndexedIcoSphere.adaptive(lambda p: float(p.vector[0] > 0.3), 0.5, max_depth=6, min_depth=1)
+    directions = random_directions(5000, 8)
+    faces, _ = sphere.locate(directions)
+    w = np.einsum("fij,nj->nfi", sphere.inverse_matrices, directions).min(axis=-1)
+    return np.mean(faces != np.argmax(w, axis=1)), 0
+
+def run_checks():
+    failed = 0
+    for f in checks:
+        error, tolerance = f()
+        ok = error <= tolerance
+        failed += not ok
+        print("%-40s %10.2e %s" % (f.__name__, error, "ok" if ok else "FAILED"), file=sys.stderr)
+    return failed
+
+def measure(run, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+def run_benchmarks(selected, repeat, workdir):
+    results = []
+    for b in selected:
+        result = dict(name=b["name"], params=b["params"])
+        try:
+            run = b["setup"](workdir=workdir, **b["params"])
+            result["seconds"], result["peak_bytes"] = measure(run, repeat)
+            result["status"] = "ok"
+        except ImportError as e:
+            result["status"] = "skipped: %s" % e
+        print("%-40s %s" % (b["name"], format_result(result)), file=sys.stderr)
+        results.append(result)
+    return results
+
+def format_result(result):
+    if result["status"] != "ok": return result["status"]
+    return "%10.4f s %10.1f MB" % (result["seconds"], result["peak_bytes"] / 2**20)
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                text=True, cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        commit = ""
+    return dict(commit=commit, python=platform.python_version(),
+            numpy=np.__version__, machine=platform.machine(),
+            timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+def compare(results, baseline, threshold):
+    """Print time ratios against a baseline run and return the regressions."""
+    old = {r["name"]: r for r in baseline["results"] if r.get("status") == "ok"}
+    regressions = []
+    print("%-40s %10s %10s %8s" % ("benchmark", "old s", "new s", "ratio"))
+    for r in results:
+        if r["status"] != "ok" or r["name"] not in old: continue
+        ratio = r["seconds"] / old[r["name"]]["seconds"]
+        flag = " REGRESSION" if ratio > threshold else ""
+        print("%-40s %10.4f %10.4f %8.2f%s" % (r["name"], old[r["name"]]["seconds"],
+            r["seconds"], ratio, flag))
+        if flag: regressions.append(r["name"])
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=description,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2,
+            help="time ratio above which a benchmark counts as a regression")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--quick", action="store_true", help="skip the largest sizes")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--check", action="store_true",
+            help="run the equivalence checks instead of the benchmarks")
+    args = parser.parse_args(argv)
+    if args.check: return 1 if run_checks() else 0
+
+    selected = [b for b in benchmarks
+            if args.filter in b["name"] and (b["quick"] or not args.quick)]
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run_benchmarks(selected, args.repeat, workdir)
+
+    report = dict(environment=environment(), results=results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions: return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+'''
+photometry.py. Visualize the photometric output of a Wavefront obj. model.
+Copyright (C) 2020  Drew Allen McNeely
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+# Bump when the set or meaning of cached arrays changes.
+CACHE_VERSION = 4
+
+def default_cache_dir():
+    env = os.environ.get("PHOTOMETRY_CACHE_DIR")
+    if env: return Path(env)
+    else: return Path.home() / ".cache" / "photometry"
+
+def file_hash(path, block_size=1 << 20):
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def cache_key(path, dependencies=(), **options):
+    """Key from the content hashes of the file and of the files it depends
+    on (such as the .mtl files an .obj names), the loader options and
+    CACHE_VERSION. Missing dependencies hash as absent, so creating one
+    changes the key too."""
+    h = hashlib.blake2b(digest_size=20)
+    h.update(file_hash(path).encode())
+    for d in dependencies:
+        h.update(file_hash(d).encode() if Path(d).exists() else b"absent")
+    h.update(json.dumps(options, sort_keys=True, default=str).encode())
+    h.update(str(CACHE_VERSION).encode())
+    return h.hexdigest()
+
+def save_entry(directory, arrays, metadata):
+    """Write arrays as raw .npy files plus metadata.json, atomically.
+
+    The entry is written to a temporary directory that is renamed into
+    place, so concurrent writers never expose a half-written entry; the
+    first one to finish wins.
+    """
+    directory = Path(directory)
+    directory.parent.mkdir(parents=True, exist_ok=True)
+    tmp = directory.with_name(directory.name + ".tmp-%d" % os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir()
+    for name, a in arrays.items():
+        np.save(tmp / (name + ".npy"), np.ascontiguousarray(a))
+    with open(tmp / "metadata.json", "w") as f:
+        json.dump(metadata, f)
+    try:
+        tmp.rename(directory)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def load_entry(directory, mmap_mode="r"):
+    """Arrays (memory-mapped by default) and metadata of a cache entry."""
+    directory = Path(directory)
+    arrays = {p.stem: np.load(p, mmap_mode=mmap_mode) for p in directory.glob("*.npy")}
+    with open(directory / "metadata.json") as f:
+        metadata = json.load(f)
+    return arrays, metadata
+
+def cached(path, build, cache_dir=None, dependencies=(), **options):
+    """Load the cache entry for path, dependencies and options, building it
+    if missing.
+
+    build() must return (arrays, metadata): a dict of NumPy arrays and a
+    JSON-serializable dict. Arrays are returned memory-mapped read-only,
+    so every process opening the same entry shares one copy in the page
+    cache.
+    """
+    cache_dir = Path(cache_dir) if cache_dir else default_cache_dir()
+    directory = cache_dir / cache_key(path, dependencies, **options)
+    if not (directory / "metadata.json").exists():
+        save_entry(directory, *build())
+    return load_entry(directory)
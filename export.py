@@ -0,0 +1,114 @@
+'''
+photometry.py. Visualize the photometric output of a Wavefront obj. model.
+Copyright (C) 2020  Drew Allen McNeely
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from geometry import IndexedIcoSphere, earth_latitudes, earth_longitudes
+
+# Headless output of values over sphere cells.
+#
+# .npz files hold the cell mesh (vertices, faces, levels) and the values,
+# and load back as an IndexedIcoSphere. Parquet files hold one row per
+# cell: barycenter and corner latitudes/longitudes, solid angle, level and
+# value, for tools that read columns. With float32 set, coordinates and
+# values are stored in single precision. Rendering is a separate step:
+# python3 export.py results.npz results.html.
+
+description = "Convert exported sphere values between .npz, .parquet and .html."
+
+def save_npz(path, sphere, values, float32=False, compressed=True):
+    dtype = np.float32 if float32 else float
+    save = np.savez_compressed if compressed else np.savez
+    save(path,
+        vertices=sphere.vertices.astype(dtype),
+        faces=sphere.faces.astype(np.int32),
+        levels=sphere.levels,
+        values=np.asarray(values, dtype=dtype))
+
+def load_npz(path):
+    """(IndexedIcoSphere, values) from a file written by save_npz."""
+    with np.load(path) as f:
+        sphere = IndexedIcoSphere(f["vertices"], f["faces"], f.get("levels"))
+        return sphere, np.asarray(f["values"], dtype=float)
+
+def cell_columns(sphere, values, float32=False):
+    """Dict of per-cell column arrays."""
+    dtype = np.float32 if float32 else float
+    corners = sphere.faces
+    lats = earth_latitudes(sphere.vertices)[corners]
+    lons = earth_longitudes(sphere.vertices)[corners]
+    columns = {
+        "cell": np.arange(len(sphere), dtype=np.int32),
+        "lat": sphere.bary_lats.astype(dtype),
+        "lon": sphere.bary_lons.astype(dtype),
+        }
+    for k in range(3):
+        columns["lat%d" % k] = lats[:, k].astype(dtype)
+        columns["lon%d" % k] = lons[:, k].astype(dtype)
+    columns["solid_angle"] = sphere.solid_angles.astype(dtype)
+    columns["level"] = sphere.levels
+    columns["value"] = np.asarray(values, dtype=dtype)
+    return columns
+
+def save_parquet(path, sphere, values, float32=False, compression="zstd"):
+    """Write per-cell columns with pyarrow, which is only needed here."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.table(cell_columns(sphere, values, float32))
+    pq.write_table(table, str(path), compression=compression)
+
+def save_html(path, sphere, values, float32=False):
+    from visualization import plot_sphere_values
+    plot_sphere_values(sphere, values, str(path), auto_open=False)
+
+formats = {
+    ".npz": save_npz,
+    ".parquet": save_parquet,
+    ".html": save_html,
+    }
+
+def save(path, sphere, values, float32=False):
+    """Write values over the sphere's cells in the format of path's suffix."""
+    suffix = Path(path).suffix
+    if suffix not in formats:
+        raise ValueError("unknown output format " + repr(suffix)
+                + "; expected one of " + ", ".join(formats))
+    formats[suffix](path, sphere, values, float32)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("input", help=".npz file written by save_npz")
+    parser.add_argument("outputs", nargs="+", help=".npz, .parquet or .html files")
+    parser.add_argument("--float32", action="store_true", help="single-precision output")
+    args = parser.parse_args(argv)
+    for output in args.outputs:
+        if Path(output).suffix not in formats:
+            parser.error("unknown output format " + repr(output))
+
+    sphere, values = load_npz(args.input)
+    for output in args.outputs:
+        save(output, sphere, values, args.float32)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+'''
+photometry.py. Visualize the photometric output of a Wavefront obj. model.
+Copyright (C) 2020  Drew Allen McNeely
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import numpy as np
+from numpy import pi
+
+from geometry import Rotations, as_vectors, normalize_rows
+
+# Least-squares inversion of light curves for material and spin state.
+#
+# For models whose facets all follow lambert_diffuse + blinn_phong_specular,
+# scatter_derivatives evaluates the paired brightness together with its
+# analytic derivatives with respect to each material's rho, alpha and
+# diffuse fraction and to the body-frame light and viewer directions, in
+# one pass over facets and epochs. LightCurveFit chains the direction
+# derivatives through the attitude and turns them into residual and
+# Jacobian functions for solvers such as scipy.optimize.least_squares.
+
+fitted_laws = ("lambert_diffuse", "blinn_phong_specular")
+
+def material_fractions(model):
+    """Diffuse fraction of each material of a FacetArray, 0 for materials
+    without facets. The fit has one fraction per material, so a ValueError
+    is raised when the facets of a material disagree."""
+    M = len(model.materials)
+    lo, hi = np.full(M, np.inf), np.full(M, -np.inf)
+    np.minimum.at(lo, model.material_index, model.diffuse_fractions)
+    np.maximum.at(hi, model.material_index, model.diffuse_fractions)
+    varying = np.flatnonzero(hi > lo)
+    if len(varying):
+        raise ValueError("diffuse fractions vary within material(s) "
+                + ", ".join(map(str, varying)) + "; the fit has one per material")
+    return np.where(np.isfinite(lo), lo, 0).astype(float)
+
+def scatter_derivatives(model, light_directions, viewer_directions, rho, alpha, fraction):
+    """Paired brightness of a FacetArray and its derivatives.
+
+    rho, alpha and fraction give the parameters of each of the model's
+    materials and replace those stored in it; the facets of each material
+    must share one diffuse fraction (see material_fractions). Returns B (K,), dB/drho,
+    dB/dalpha and dB/dfraction (K,M), and dB/dL and dB/dV (K,3) for K
+    body-frame direction pairs and M materials. Shadowing masks, if the
+    model has them, are held fixed.
+    """
+    if any(tuple(laws) != fitted_laws for laws in model.laws):
+        raise ValueError("derivatives are only implemented for " + " + ".join(fitted_laws))
+    material_fractions(model)
+    L = normalize_rows(as_vectors(light_directions))
+    V = normalize_rows(as_vectors(viewer_directions))
+    K, M = len(L), len(model.materials)
+    B = np.zeros(K)
+    d_rho, d_alpha, d_fraction = np.zeros((K, M)), np.zeros((K, M)), np.zeros((K, M))
+    d_L, d_V = np.zeros((K, 3)), np.zeros((K, 3))
+
+    step = max(1, model.chunk_elements // max(len(model), 1))
+    for i in range(0, K, step):
+        c = slice(i, i+step)
+        Lc, Vc = L[c], V[c]
+        h = np.maximum(2 + 2*np.sum(Lc*Vc, axis=1, keepdims=True), 0)
+        norm_h = np.sqrt(h)
+        if model.shadowing is not None:
+            lit_mask = model.shadowing.illuminated(Lc)
+            seen_mask = model.shadowing.visible(Vc)
+        for facets, _, _, _ in model.groups:
+            m = model.material_index[facets][0]
+            N = model.normals[facets]
+            mu_0 = Lc @ N.T
+            mu = Vc @ N.T
+            lit = (mu >= 0) & (mu_0 >= 0)
+            if model.shadowing is not None:
+                lit &= lit_mask[:, facets] & seen_mask[:, facets]
+            A = np.where(lit, model.areas[facets], 0)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                NH = np.clip(np.where(norm_h > 0, (mu_0 + mu) / norm_h, 0), 0, None)
+            p = 4*alpha[m]
+            spec = np.power(NH, p, out=np.zeros_like(NH), where=NH > 0)
+            d, s = fraction[m], 1 - fraction[m]
+            R = d*rho[m]/pi + s*spec
+            w = A*mu*mu_0
+
+            B[c] += (w*R).sum(axis=1)
+            d_rho[c, m] += w.sum(axis=1) * d/pi
+            d_fraction[c, m] += (w*(rho[m]/pi - spec)).sum(axis=1)
+            log_NH = np.log(NH, out=np.zeros_like(NH), where=NH > 0)
+            d_alpha[c, m] += 4*s*(w*spec*log_NH).sum(axis=1)
+
+            # d(NH)/dL = N/|H| - NH V/|H|^2, and symmetrically for V.
+            g = s*p*w*np.divide(spec, NH, out=np.zeros_like(NH), where=NH > 0)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                g_h = np.where(norm_h > 0, g / norm_h, 0)
+                g_v = np.where(h > 0, (g*NH).sum(axis=1, keepdims=True) / h, 0)
+            d_L[c] += (A*mu*R + g_h) @ N - g_v*Vc
+            d_V[c] += (A*mu_0*R + g_h) @ N - g_v*Lc
+    return B, d_rho, d_alpha, d_fraction, d_L, d_V
+
+def skew(v):
+    """(K,3,3) cross-product matrices of (K,3) vectors."""
+    x, y, z = as_vectors(v).T
+    o = np.zeros_like(x)
+    return np.stack([
+        np.stack([o, -z, y], axis=-1),
+        np.stack([z, o, -x], axis=-1),
+        np.stack([-y, x, o], axis=-1),
+        ], axis=-2)
+
+def right_jacobians(vectors):
+    """(K,3,3) right Jacobians J of the rotation-vector exponential, with
+    d(exp(v) u)/dv = -exp(v) [u]x J(v)."""
+    v = as_vectors(vectors)
+    theta = np.linalg.norm(v, axis=1)[:, None, None]
+    small = theta < 1e-4
+    t = np.where(small, 1, theta)
+    a = np.where(small, 1/2 - theta**2/24, (1 - np.cos(t)) / t**2)
+    b = np.where(small, 1/6 - theta**2/120, (t - np.sin(t)) / t**3)
+    S = skew(v)
+    return np.identity(3) - a*S + b*(S @ S)
+
+class LightCurveFit:
+    """Fit of material parameters and spin state to observed brightness.
+
+    The attitude at time t is R_ref(t) exp([phi]) exp([omega] (t - epoch)):
+    the reference attitudes (identity by default) corrected by a fixed
+    rotation vector phi and a uniform spin omega about a body-frame axis.
+    The parameter vector holds, in this order and for the names listed in
+    fit, each material's rho, each material's alpha, each material's
+    diffuse fraction, phi ("attitude") and omega ("spin"). Residuals are
+    (B - observed) / sigma.
+    """
+    parameters = ("rho", "alpha", "diffuse_fraction", "attitude", "spin")
+
+    def __init__(self, model, times, sun_directions, observer_directions, observed,
+            attitudes=None, sigma=1, fit=parameters, epoch=None):
+        self.model = getattr(model, "facet_model", model)
+        self.times = np.asarray(times, dtype=float)
+        self.epoch = self.times[0] if epoch is None else epoch
+        self.reference = Rotations.identity() if attitudes is None else Rotations.from_attitudes(attitudes)
+        # Directions in the reference body frame, R_ref^T v.
+        self.sun = self.reference.apply_inverse(normalize_rows(as_vectors(sun_directions)))
+        self.observer = self.reference.apply_inverse(normalize_rows(as_vectors(observer_directions)))
+        self.observed = np.asarray(observed, dtype=float)
+        self.sigma = np.broadcast_to(np.asarray(sigma, dtype=float), self.observed.shape)
+        unknown = set(fit) - set(self.parameters)
+        if unknown: raise ValueError("unknown parameters " + ", ".join(sorted(unknown)))
+        self.fit = [p for p in self.parameters if p in fit]
+
+        model = self.model
+        self.initial = {
+            "rho": np.array([m.rho for m in model.materials], dtype=float),
+            "alpha": np.array([m.alpha for m in model.materials], dtype=float),
+            "diffuse_fraction": material_fractions(model),
+            "attitude": np.zeros(3),
+            "spin": np.zeros(3),
+            }
+        self._last = None
+
+    @property
+    def x0(self):
+        return np.concatenate([self.initial[p] for p in self.fit])
+
+    def unpack(self, x):
+        """Dict of every parameter, taking fitted ones from x."""
+        values = dict(self.initial)
+        i = 0
+        for p in self.fit:
+            n = len(self.initial[p])
+            values[p] = np.asarray(x[i:i+n], dtype=float)
+            i += n
+        return values
+
+    def attitudes(self, x):
+        """Rotations at each epoch for parameter vector x."""
+        v = self.unpack(x)
+        tau = (self.times - self.epoch)[:, None]
+        spin = Rotations.from_rotation_vectors(v["spin"] * tau)
+        return spin.compose(Rotations.from_rotation_vectors(v["attitude"])).compose(self.reference)
+
+    def evaluate(self, x):
+        """(residuals, Jacobian) at x, from one pass over facets and epochs."""
+        x = np.asarray(x, dtype=float)
+        if self._last is not None and np.array_equal(self._last[0], x):
+            return self._last[1]
+        v = self.unpack(x)
+        tau = (self.times - self.epoch)[:, None]
+        phi = v["attitude"][None, :]
+        omega_tau = v["spin"] * tau
+        # Body-frame directions exp(-[omega tau]) exp(-[phi]) R_ref^T v.
+        undo_phi = Rotations.from_rotation_vectors(-phi)
+        undo_spin = Rotations.from_rotation_vectors(-omega_tau)
+        u_L = undo_phi.apply(self.sun)
+        u_V = undo_phi.apply(self.observer)
+        L = undo_spin.apply(u_L)
+        V = undo_spin.apply(u_V)
+
+        B, d_rho, d_alpha, d_fraction, d_L, d_V = scatter_derivatives(
+                self.model, L, V, v["rho"], v["alpha"], v["diffuse_fraction"])
+
+        columns = {"rho": d_rho, "alpha": d_alpha, "diffuse_fraction": d_fraction}
+        if "attitude" in self.fit:
+            # d(exp(-[phi]) w)/dphi = exp(-[phi]) [w]x J(-phi), then the spin.
+            J = right_jacobians(-phi)[0]
+            total = np.zeros((len(L), 3))
+            for g, w in ((d_L, self.sun), (d_V, self.observer)):
+                y = undo_phi.inverse.apply(undo_spin.inverse.apply(g))
+                total += np.cross(y, w) @ J
+            columns["attitude"] = total
+        if "spin" in self.fit:
+            J = right_jacobians(-omega_tau)
+            total = np.zeros((len(L), 3))
+            for g, u in ((d_L, u_L), (d_V, u_V)):
+                y = undo_spin.inverse.apply(g)
+                total += np.einsum("ki,kij->kj", np.cross(y, u), J)
+            columns["spin"] = total * tau
+
+        residuals = (B - self.observed) / self.sigma
+        jacobian = np.hstack([columns[p] for p in self.fit]) / self.sigma[:, None]
+        self._last = (x.copy(), (residuals, jacobian))
+        return residuals, jacobian
+
+    def residuals(self, x): return self.evaluate(x)[0]
+    def jacobian(self, x): return self.evaluate(x)[1]
+
+    def fitted(self, x):
+        """Copy of the model carrying the material parameters of x."""
+        from copy import copy
+        v = self.unpack(x)
+        model = copy(self.model)
+        model.materials = [copy(m) for m in self.model.materials]
+        for m, rho, alpha in zip(model.materials, v["rho"], v["alpha"]):
+            m.rho, m.alpha = rho, alpha
+        model.diffuse_fractions = v["diffuse_fraction"][self.model.material_index]
+        model.__dict__.pop("groups", None)
+        return model
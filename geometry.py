@@ -23,6 +23,9 @@ from numpy import array, dot as npdot, pi, sin, cos, arctan2, arccos, sqrt
 from numpy.linalg import norm
 
 from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import update_wrapper, cached_property
+
 
 import geojson as gj
 
@@ -33,6 +36,72 @@ def normalize(v):
     if n==0: return v
     else: return v/n
 
+def normalize_rows(vs):
+    """Normalize each row of an (N,3) array, leaving zero rows untouched."""
+    vs = np.asarray(vs, dtype=float)
+    n = norm(vs, axis=-1, keepdims=True)
+    return np.divide(vs, n, out=np.array(vs), where=n>0)
+
+def as_vector(p):
+    """Return the vector of a SpherePoint, or the argument itself as an array."""
+    if isinstance(p, SpherePoint): return p.vector
+    else: return np.asarray(p, dtype=float)
+
+def as_vectors(ps):
+    """Stack SpherePoints or vectors into an (N,3) array."""
+    if isinstance(ps, np.ndarray): return ps.reshape(-1, 3).astype(float)
+    elif isinstance(ps, SpherePoint): return ps.vector.reshape(1, 3)
+    else: return np.array([as_vector(p) for p in ps], dtype=float).reshape(-1, 3)
+
+class vectorized:
+    """Mark a function of directions as vectorized.
+
+    mapf hands a vectorized function an (N,3) array of unit vectors and
+    expects N values back, instead of calling it once per SpherePoint.
+    """
+    is_vectorized = True
+
+    def __init__(self, f):
+        self.f = f
+        update_wrapper(self, f)
+
+    def __call__(self, vectors): return self.f(vectors)
+
+def _map_chunk(f, vectors):
+    if getattr(f, "is_vectorized", False): return list(f(vectors))
+    else: return [f(SpherePoint(v)) for v in vectors]
+
+executors = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}
+
+def map_directions(f, directions, executor=None, workers=None, chunk_size=1024,
+        progress=True):
+    """Evaluate f at every direction of an (N,3) array, returning a list.
+
+    Directions are split into chunks of chunk_size and, with progress set,
+    progress is reported per chunk. executor is None (run here), "thread", "process" or an
+    Executor instance; workers sets the pool size of the named executors.
+    Functions sent to a process pool must be picklable.
+    """
+    vectors = as_vectors(directions)
+    chunks = [vectors[i:i+chunk_size] for i in range(0, len(vectors), chunk_size)]
+    bar = pb.ProgressBar(max_value=len(vectors)) if progress else pb.NullBar()
+    results = []
+
+    def collect(chunk_results):
+        for r in chunk_results:
+            results.extend(r)
+            bar.update(len(results))
+
+    if executor is None:
+        collect(_map_chunk(f, c) for c in chunks)
+    elif isinstance(executor, Executor):
+        collect(executor.map(_map_chunk, [f]*len(chunks), chunks))
+    else:
+        with executors[executor](max_workers=workers) as pool:
+            collect(pool.map(_map_chunk, [f]*len(chunks), chunks))
+    bar.finish()
+    return results
+
 flatten = lambda l: [item for sublist in l for item in sublist]
 
 class Angle:
@@ -139,7 +208,7 @@ class SpherePoint:
         return real
     cos_between = dot
 
-    def angle_between(s1, s2): return acos(cos_between(s1, s2))
+    def angle_between(s1, s2): return arccos(np.clip(s1.dot(s2), -1, 1))
     distance_between = angle_between
 
     # Functions for combining
@@ -246,6 +315,47 @@ class SphereTriangle:
 
     def mapf(t, f): return f(t.barycenter)
 
+_t = (1.0 + sqrt(5.0)) / 2.0
+_a = 0
+
+icosahedron_vectors = [
+    [-1, _t, _a],
+    [ 1, _t, _a],
+    [-1,-_t, _a],
+    [ 1,-_t, _a],
+    [_a, -1, _t],
+    [_a,  1, _t],
+    [_a, -1,-_t],
+    [_a,  1,-_t],
+    [_t, _a, -1],
+    [_t, _a,  1],
+    [-_t,_a, -1],
+    [-_t,_a,  1]
+    ]
+
+icosahedron_faces = [
+    [0, 11, 5],
+    [0, 5, 1],
+    [0, 1, 7],
+    [0, 7, 10],
+    [0, 10, 11],
+    [1, 5, 9],
+    [5, 11, 4],
+    [11, 10, 2],
+    [10, 7, 6],
+    [7, 1, 8],
+    [3, 9, 4],
+    [3, 4, 2],
+    [3, 2, 6],
+    [3, 6, 8],
+    [3, 8, 9],
+    [4, 9, 5],
+    [2, 4, 11],
+    [6, 2, 10],
+    [8, 6, 7],
+    [9, 8, 1]
+    ]
+
 class IcoSphere:
     def __init__(self, triangles):
         self.triangles = triangles
@@ -257,14 +367,19 @@ class IcoSphere:
         return s
 
     @property
-    def north_poles(self):
-        pole = SpherePoint.north_pole()
-        return [point_is_inside_triangle(pole, t) for t in self.triangles]
+    def point_matrices(self):
+        """(F,3,3) matrices with each triangle's vertices as columns."""
+        return np.array([t.point_matrix for t in self.triangles])
+
+    def contains(self, point):
+        """Whether each triangle contains point."""
+        return list(points_are_inside_triangles(point.vector, self.point_matrices))
+
+    @property
+    def north_poles(self): return self.contains(SpherePoint.north_pole())
 
     @property
-    def south_poles(self):
-        pole = SpherePoint.south_pole()
-        return [point_is_inside_triangle(pole, t) for t in self.triangles]
+    def south_poles(self): return self.contains(SpherePoint.south_pole())
 
     @property
     def divided_once(self):
@@ -316,57 +431,13 @@ class IcoSphere:
         if all([t.is_clockwise for t in self.triangles]): return True
         else: return False
 
-    def mapf(s, f):
-        results = []
-        for t in pb.progressbar(s.triangles):
-            results += [t.mapf(f)]
-        return results
+    def mapf(s, f, executor=None, workers=None, chunk_size=1024):
+        return map_directions(f, s.barycenters, executor, workers, chunk_size)
 
     @classmethod
     def icosahedron(cls):
-        t = (1.0 + sqrt(5.0)) / 2.0;
-        a = 0
-
-        vectors = [
-            [-1,  t,  a],
-            [ 1,  t,  a],
-            [-1, -t,  a],
-            [ 1, -t,  a],
-            [ a, -1,  t],
-            [ a,  1,  t],
-            [ a, -1, -t],
-            [ a,  1, -t],
-            [ t,  a, -1],
-            [ t,  a,  1],
-            [-t,  a, -1],
-            [-t,  a,  1]
-            ]
-        points = [SpherePoint.from_list(l) for l in vectors]
-
-        idxs = [
-            [0, 11, 5],
-            [0, 5, 1],
-            [0, 1, 7],
-            [0, 7, 10],
-            [0, 10, 11],
-            [1, 5, 9],
-            [5, 11, 4],
-            [11, 10, 2],
-            [10, 7, 6],
-            [7, 1, 8],
-            [3, 9, 4],
-            [3, 4, 2],
-            [3, 2, 6],
-            [3, 6, 8],
-            [3, 8, 9],
-            [4, 9, 5],
-            [2, 4, 11],
-            [6, 2, 10],
-            [8, 6, 7],
-            [9, 8, 1]
-            ]
-
-        tris = [SphereTriangle.from_indices(idx, points) for idx in idxs]
+        points = [SpherePoint.from_list(l) for l in icosahedron_vectors]
+        tris = [SphereTriangle.from_indices(idx, points) for idx in icosahedron_faces]
         return cls(tris)
 
     @property
@@ -408,6 +479,359 @@ class IcoSphere:
         ts = [t.rotated_by(R) for t in self.triangles]
         return IcoSphere.from_triangle_list(ts)
 
+def earth_latitudes(vs):
+    return Angle.to_degrees(Angle.from_degrees(90.0) - arccos(np.clip(vs[..., 2], -1, 1)))
+
+def earth_longitudes(vs):
+    return Angle.to_degrees(arctan2(vs[..., 1], vs[..., 0]))
+
+class IndexedIcoSphere:
+    """Icosphere held as a (V,3) unit vertex array and an (F,3) face array.
+
+    Vertices are shared between faces. Subdivision looks up each edge
+    midpoint once, and keeps the children of face i at faces 4i..4i+3 in
+    the same order as SphereTriangle.divided, so face i of level n lies
+    inside face i//4 of level n-1.
+    """
+    def __init__(self, vertices, faces, levels=None):
+        self.vertices = np.ascontiguousarray(vertices, dtype=float)
+        self.faces = np.ascontiguousarray(faces, dtype=np.intp)
+        # Number of subdivisions of the icosahedron that produced each face.
+        if levels is None: levels = np.zeros(len(self.faces), dtype=np.int8)
+        self.levels = np.asarray(levels, dtype=np.int8)
+
+    def __len__(self): return len(self.faces)
+
+    @classmethod
+    def icosahedron(cls):
+        vertices = normalize_rows(np.array(icosahedron_vectors, dtype=float))
+        return cls(vertices, icosahedron_faces)
+
+    @classmethod
+    def sphere(cls): return cls.icosahedron().divided(3)
+
+    @property
+    def edge_midpoints(self):
+        """Midpoint vertices for the unique edges, and the index of the midpoint
+        of each face's edges (p1,p2), (p2,p3), (p3,p1) as an (F,3) array.
+        """
+        F = self.faces
+        edges = np.stack([F, np.roll(F, -1, axis=1)], axis=-1)
+        n = len(self.vertices)
+        keys = np.min(edges, axis=-1).astype(np.int64) * n + np.max(edges, axis=-1)
+        unique, inverse = np.unique(keys.ravel(), return_inverse=True)
+        a, b = np.divmod(unique, n)
+        mids = normalize_rows(self.vertices[a] + self.vertices[b])
+        return mids, n + inverse.reshape(F.shape)
+
+    @staticmethod
+    def children(p, m):
+        """(F,4,3) child faces of faces p with edge midpoint indices m."""
+        m1, m2, m3 = m.T
+        return np.stack([
+            np.stack([p[:,0], m1, m3], axis=-1),
+            np.stack([p[:,1], m2, m1], axis=-1),
+            np.stack([p[:,2], m3, m2], axis=-1),
+            m,
+            ], axis=1)
+
+    @property
+    def divided_once(self):
+        mids, m = self.edge_midpoints
+        children = self.children(self.faces, m)
+        vertices = np.concatenate([self.vertices, mids])
+        levels = np.repeat(self.levels + 1, 4)
+        return IndexedIcoSphere(vertices, children.reshape(-1, 3), levels)
+
+    def divided(self, n=1):
+        s = self
+        for _ in range(n):
+            s = s.divided_once
+        return s
+
+    @classmethod
+    def adaptive(cls, f, tol, max_depth=7, min_depth=2,
+            executor=None, workers=None, chunk_size=1024):
+        """Icosphere refined where f varies by more than tol.
+
+        The icosahedron is divided min_depth times uniformly, so that
+        features narrower than a face are still sampled, and then refined
+        up to max_depth. See refined.
+        """
+        s = cls.icosahedron().divided(min_depth)
+        return s.refined(f, tol, max_depth - min_depth, executor, workers, chunk_size)
+
+    def refined(self, f, tol, depth, executor=None, workers=None, chunk_size=1024):
+        """Subdivide, up to depth times, the faces over which f varies by more than tol.
+
+        f is evaluated as in mapf at the vertices and barycenter of each face,
+        and a face is split into its four children when those values spread
+        by more than tol. Only new children are tested again. The result
+        mixes faces of different levels; neighbours share the vertices they
+        have in common, so a coarse face may have a finer neighbour's
+        midpoint on its edge.
+        """
+        def evaluate(directions):
+            values = map_directions(f, directions, executor, workers, chunk_size,
+                    progress=False)
+            return np.asarray(values, dtype=float)
+
+        vertices = self.vertices
+        faces = self.faces
+        levels = self.levels
+        values = evaluate(vertices)
+        active = np.ones(len(faces), dtype=bool)
+        # Sorted keys of the edges already split, and their midpoint vertices.
+        edge_keys = np.zeros(0, dtype=np.int64)
+        edge_mids = np.zeros(0, dtype=np.intp)
+
+        for _ in range(depth):
+            tested = np.flatnonzero(active)
+            if len(tested) == 0: break
+            tri = faces[tested]
+            bary = normalize_rows(vertices[tri].sum(axis=1))
+            samples = np.column_stack([values[tri], evaluate(bary)])
+            split = np.zeros(len(faces), dtype=bool)
+            split[tested] = np.ptp(samples, axis=1) > tol
+            if not split.any(): break
+
+            p = faces[split]
+            edges = np.stack([p, np.roll(p, -1, axis=1)], axis=-1)
+            keys = np.min(edges, axis=-1).astype(np.int64) << 32 | np.max(edges, axis=-1)
+            unique, inverse = np.unique(keys.ravel(), return_inverse=True)
+            pos = np.minimum(np.searchsorted(edge_keys, unique), max(len(edge_keys) - 1, 0))
+            found = (edge_keys[pos] == unique) if len(edge_keys) else np.zeros(len(unique), dtype=bool)
+            new = unique[~found]
+            index = np.empty(len(unique), dtype=np.intp)
+            index[found] = edge_mids[pos[found]]
+            index[~found] = len(vertices) + np.arange(len(new))
+            mids = normalize_rows(vertices[new >> 32] + vertices[new & 0xffffffff])
+            vertices = np.concatenate([vertices, mids])
+            values = np.concatenate([values, evaluate(mids)])
+            edge_keys = np.concatenate([edge_keys, new])
+            edge_mids = np.concatenate([edge_mids, index[~found]])
+            order = np.argsort(edge_keys)
+            edge_keys, edge_mids = edge_keys[order], edge_mids[order]
+
+            # Put the children of each split face where the face was.
+            counts = np.where(split, 4, 1)
+            start = np.cumsum(counts) - counts
+            slots = start[split][:, None] + np.arange(4)
+            kept = start[~split]
+            out = np.empty((counts.sum(), 3), dtype=np.intp)
+            out[kept] = faces[~split]
+            out[slots] = self.children(p, index[inverse].reshape(p.shape))
+            out_levels = np.empty(len(out), dtype=np.int8)
+            out_levels[kept] = levels[~split]
+            out_levels[slots] = levels[split, None] + 1
+            active = np.zeros(len(out), dtype=bool)
+            active[slots] = True
+            faces, levels = out, out_levels
+
+        return IndexedIcoSphere(vertices, faces, levels)
+
+    @property
+    def triangle_vectors(self):
+        """(F,3,3) array of each face's vertex vectors."""
+        return self.vertices[self.faces]
+
+    @property
+    def barycenters(self):
+        return normalize_rows(self.triangle_vectors.sum(axis=1))
+
+    @property
+    def solid_angles(self):
+        """Solid angle of each spherical face; they sum to 4 pi."""
+        a, b, c = self.triangle_vectors.transpose(1, 0, 2)
+        triple = np.abs(np.einsum("ij,ij->i", a, np.cross(b, c)))
+        ab = np.einsum("ij,ij->i", a, b)
+        bc = np.einsum("ij,ij->i", b, c)
+        ca = np.einsum("ij,ij->i", c, a)
+        return 2*arctan2(triple, 1 + ab + bc + ca)
+
+    @property
+    def point_lats(self): return earth_latitudes(self.vertices)
+    @property
+    def point_lons(self): return earth_longitudes(self.vertices)
+
+    @property
+    def bary_lats(self): return earth_latitudes(self.barycenters)
+    @property
+    def bary_lons(self): return earth_longitudes(self.barycenters)
+
+    @property
+    def triangles(self):
+        """The faces as SphereTriangles, sharing one SpherePoint per vertex."""
+        points = [SpherePoint(v) for v in self.vertices]
+        return [SphereTriangle.from_indices(f, points) for f in self.faces]
+
+    def rotated_by(self, R):
+        R = attitude_matrices(R)[0]
+        return IndexedIcoSphere(self.vertices @ R.T, self.faces, self.levels)
+
+    # Point location
+    @cached_property
+    def inverse_matrices(self):
+        """(F,3,3) inverses of the matrices with each face's vertices as columns."""
+        return np.linalg.inv(self.triangle_vectors.transpose(0, 2, 1))
+
+    @cached_property
+    def depth(self):
+        """Subdivision level when this is the icosahedron divided n times,
+        so that faces 4i..4i+3 are the children of face i of the level
+        above; None otherwise."""
+        n = 0
+        while 20 * 4**n < len(self.faces): n += 1
+        if 20 * 4**n != len(self.faces): return None
+        if np.any(self.levels != self.levels[0]) or self.levels[0] not in (0, n): return None
+        return n
+
+    @cached_property
+    def hierarchy(self):
+        """Face arrays of every level from the icosahedron down to this one.
+
+        Child faces k=0,1,2 of face i start at its corner k, so the faces of
+        the level above are the first corners of each group of four.
+        """
+        if self.depth is None:
+            raise ValueError("sphere is not a uniform subdivision of the icosahedron")
+        faces = [self.faces]
+        for _ in range(self.depth):
+            faces.append(faces[-1].reshape(-1, 4, 3)[:, :3, 0])
+        return faces[::-1]
+
+    @cached_property
+    def separators(self):
+        """Per level, the (F,3,3) normals of the great circles splitting
+        each face into its children.
+
+        Row k separates corner child k from the middle child (m1,m2,m3),
+        and is oriented so that the middle child is on its positive side.
+        """
+        planes = []
+        for children in self.hierarchy[1:]:
+            m1, m2, m3 = self.vertices[children[3::4]].transpose(1, 0, 2)
+            n = np.stack([np.cross(m3, m1), np.cross(m1, m2), np.cross(m2, m3)], axis=1)
+            sign = np.sign(np.einsum("ij,ij->i", n[:, 0], m2))
+            planes.append(n * sign[:, None, None])
+        return planes
+
+    @cached_property
+    def top_inverse_matrices(self):
+        """(3,60) inverse_matrices of the icosahedron faces of hierarchy,
+        laid out so that directions @ them give the weight of corner k of
+        face i in column 20k+i."""
+        inverse = IndexedIcoSphere(self.vertices, self.hierarchy[0]).inverse_matrices
+        return np.ascontiguousarray(inverse.transpose(2, 1, 0).reshape(3, 60))
+
+    def descend(self, directions):
+        """Containing face of (N,3) unit directions, found by choosing among
+        the 20 icosahedron faces and then, at each level, among the four
+        children of the current face: O(log F) work per direction."""
+        w = directions @ self.top_inverse_matrices
+        faces = np.argmax(np.minimum(np.minimum(w[:, :20], w[:, 20:40]), w[:, 40:]), axis=1)
+        for planes in self.separators:
+            # A direction is behind at most one separator: the one of the
+            # corner child it is in.
+            d = np.einsum("nij,nj->in", planes[faces], directions)
+            faces = 4*faces + np.where(d[0] < 0, 0, np.where(d[1] < 0, 1, np.where(d[2] < 0, 2, 3)))
+        return faces
+
+    @cached_property
+    def level_trees(self):
+        """Per subdivision level, its faces, a KD-tree of their barycenters
+        and the farthest any of their corners lies from the barycenter."""
+        from scipy.spatial import cKDTree
+        reach = np.linalg.norm(self.triangle_vectors - self.barycenters[:, None], axis=-1).max(axis=1)
+        trees = []
+        for level in np.unique(self.levels):
+            faces = np.flatnonzero(self.levels == level)
+            trees.append((faces, cKDTree(self.barycenters[faces]), reach[faces].max()))
+        return trees
+
+    def nearby_faces(self, directions, k):
+        """(N,k*L) faces, k of each of the L levels, whose barycenters are
+        nearest to directions and near enough for them to be inside; padded
+        with -1. The face containing a direction is always near enough."""
+        nearby = []
+        for faces, tree, reach in self.level_trees:
+            d, i = tree.query(directions, k, distance_upper_bound=reach)
+            i = np.minimum(i, len(faces) - 1).reshape(len(directions), -1)
+            nearby.append(np.where(np.isfinite(d).reshape(i.shape), faces[i], -1))
+        return np.concatenate(nearby, axis=1)
+
+    def barycentric(self, directions, faces):
+        """Planar barycentric weights of directions in the given faces.
+
+        Weights are those of the point where the direction crosses the
+        face's plane, so they sum to one and are all non-negative exactly
+        when the direction lies inside the face.
+        """
+        p = np.asarray(directions, dtype=float)
+        w = np.einsum("...ij,...j->...i", self.inverse_matrices[faces], p)
+        return w / w.sum(axis=-1, keepdims=True)
+
+    def locate(self, directions, chunk_size=65536):
+        """Containing face and barycentric weights for (N,3) directions.
+
+        Uniform subdivisions of the icosahedron are descended level by
+        level (see descend), chunk_size directions at a time. On other
+        spheres, where faces of different levels meet, the containing face
+        is looked for among the nearby_faces of each level, first a few and
+        then more; directions none of these contain are searched for among
+        all faces, and the face they are least outside of is returned.
+        """
+        p = normalize_rows(as_vectors(directions))
+        if self.depth is not None: search = self.descend
+        else: search = lambda q: self._search(q, chunk_size)
+        faces = np.concatenate([search(p[i:i+chunk_size])
+            for i in range(0, len(p), chunk_size)] or [np.zeros(0, dtype=np.intp)])
+        return faces, self.barycentric(p, faces)
+
+    def _search(self, directions, chunk_size):
+        faces = np.zeros(len(directions), dtype=np.intp)
+        todo = np.arange(len(directions))
+        for k in (2, 8):
+            if len(todo) == 0: break
+            faces[todo] = self._best_face(directions[todo], self.nearby_faces(directions[todo], k))
+            inside = points_are_inside_triangles(directions[todo],
+                self.triangle_vectors[faces[todo]].transpose(0, 2, 1))
+            todo = todo[~inside]
+        rows = max(chunk_size // len(self.faces), 1)
+        everywhere = np.arange(len(self.faces))
+        for i in range(0, len(todo), rows):
+            chunk = todo[i:i+rows]
+            faces[chunk] = self._best_face(directions[chunk], everywhere)
+        return faces
+
+    def _best_face(self, directions, candidates):
+        """Of the (N,k) or (k,) candidate faces, padded with -1, the one each
+        direction is least outside of."""
+        candidates = np.broadcast_to(candidates, (len(directions), np.shape(candidates)[-1]))
+        # Unnormalized weights: normalizing would make the faces opposite
+        # a direction, where all three are negative, look like it.
+        w = np.einsum("nkij,nj->nki", self.inverse_matrices[np.maximum(candidates, 0)], directions)
+        score = np.where(candidates >= 0, w.min(axis=-1), -np.inf)
+        return candidates[np.arange(len(directions)), np.argmax(score, axis=1)]
+
+    def mapf(s, f, executor=None, workers=None, chunk_size=1024):
+        """Evaluate f at every barycenter. See map_directions."""
+        return map_directions(f, s.barycenters, executor, workers, chunk_size)
+
+    @property
+    def geojson(self):
+        """GeoJSON FeatureCollection of the faces, as in IcoSphere.geojson."""
+        rings = self.faces[:, [0,2,1,0]]
+        lons = earth_longitudes(self.vertices)[rings]
+        lats = earth_latitudes(self.vertices)[rings]
+        coords = np.stack([lons, lats], axis=-1).tolist()
+        features = [
+                {"type": "Feature",
+                 "geometry": {"type": "Polygon", "coordinates": [ring]},
+                 "id": i}
+                for i, ring in enumerate(coords)]
+        return gj.FeatureCollection(features)
+
 class Rotation:
     def __init__(self, R):
         self.R = R
@@ -462,11 +886,189 @@ class Rotation:
 
     def compose(A, B): return Rotation(B.matrix @ A.matrix)
     def rotate_vector(self, v): return self.matrix @ v
+    def rotate_vectors(self, vs): return as_vectors(vs) @ self.matrix.T
+
+class Rotations:
+    """Stack of K rotations, held as (K,3,3) matrices or (K,4) quaternions.
+
+    Quaternions are (w, x, y, z). Whichever form the stack was made from is
+    kept, and the other is computed on first use. Like Rotation, a
+    rotation maps body-frame vectors into the inertial frame, and
+    A.compose(B) applies A first.
+    """
+    def __init__(self, matrices=None, quaternions=None):
+        if matrices is not None:
+            self.__dict__["matrices"] = np.reshape(np.asarray(matrices, dtype=float), (-1, 3, 3))
+        if quaternions is not None:
+            self.__dict__["quaternions"] = normalize_rows(np.reshape(quaternions, (-1, 4)))
+
+    @classmethod
+    def from_matrices(cls, matrices): return cls(matrices=matrices)
+
+    @classmethod
+    def from_quaternions(cls, quaternions): return cls(quaternions=quaternions)
+
+    @classmethod
+    def from_attitudes(cls, attitudes):
+        """Stack of Rotations, (3,3) matrices or (4,) quaternions."""
+        if isinstance(attitudes, Rotations): return attitudes
+        if isinstance(attitudes, Rotation): return cls(matrices=attitudes.matrix)
+        if not isinstance(attitudes, np.ndarray):
+            attitudes = [a.matrix if isinstance(a, Rotation) else a for a in attitudes]
+        A = np.asarray(attitudes, dtype=float)
+        if A.shape[-1] == 4: return cls(quaternions=A)
+        else: return cls(matrices=A)
+
+    @classmethod
+    def from_axis_angles(cls, axes, angles):
+        axes = normalize_rows(as_vectors(axes))
+        half = np.reshape(angles, (-1, 1)) / 2
+        return cls(quaternions=np.hstack([cos(half), sin(half) * axes]))
+
+    @classmethod
+    def from_rotation_vectors(cls, vectors):
+        """Rotations by |v| about v for (K,3) rotation vectors, zero included."""
+        v = as_vectors(vectors)
+        angle = np.linalg.norm(v, axis=1, keepdims=True)
+        # sin(angle/2)/angle, which tends to 1/2 at zero.
+        s = np.sinc(angle / (2*pi)) / 2
+        return cls(quaternions=np.hstack([cos(angle/2), s * v]))
+
+    @classmethod
+    def identity(cls, k=1):
+        return cls(quaternions=np.tile([1.0, 0, 0, 0], (k, 1)))
+
+    def __len__(self):
+        return len(self.__dict__.get("quaternions", self.__dict__.get("matrices")))
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)): index = slice(index, index + 1 or None)
+        stored = {k: v[index] for k, v in self.__dict__.items()
+                if k in ("matrices", "quaternions")}
+        return Rotations(**stored)
+
+    def rotation(self, i): return Rotation(self.matrices[i])
+
+    @cached_property
+    def matrices(self): return quaternion_matrices(self.quaternions)
+
+    @cached_property
+    def quaternions(self): return matrix_quaternions(self.matrices)
+
+    @property
+    def inverse(self):
+        if "quaternions" in self.__dict__:
+            return Rotations(quaternions=self.quaternions * [1, -1, -1, -1])
+        return Rotations(matrices=self.matrices.transpose(0, 2, 1))
+
+    def compose(A, B):
+        """Rotations applying A and then B, broadcasting stacks of one."""
+        if "quaternions" in A.__dict__ or "quaternions" in B.__dict__:
+            return Rotations(quaternions=quaternion_products(B.quaternions, A.quaternions))
+        return Rotations(matrices=B.matrices @ A.matrices)
+
+    def apply(self, vectors):
+        """Rotate (K,3) vectors by their rotations; stacks of one broadcast."""
+        return np.einsum("...ij,...j->...i", self.matrices, as_vectors(vectors))
+
+    def apply_inverse(self, vectors):
+        """Rotate (K,3) inertial vectors into the body frames."""
+        return np.einsum("...ji,...j->...i", self.matrices, as_vectors(vectors))
+
+    def apply_all(self, vectors):
+        """(K,N,3) array of every rotation applied to every one of (N,3) vectors."""
+        return np.einsum("kij,nj->kni", self.matrices, as_vectors(vectors))
+
+    def slerp(self, sample_times, times):
+        """Rotations at times, interpolated along the shortest arc between
+        this stack's attitudes at the strictly increasing sample_times,
+        raising ValueError otherwise. Times outside the samples take the
+        first or last attitude."""
+        sample_times = np.asarray(sample_times, dtype=float)
+        if np.any(np.diff(sample_times) <= 0):
+            raise ValueError("sample_times must be strictly increasing")
+        times = np.atleast_1d(np.asarray(times, dtype=float))
+        q = self.quaternions
+        if len(q) == 1: return Rotations(quaternions=np.repeat(q, len(times), axis=0))
+        i = np.clip(np.searchsorted(sample_times, times, side="right") - 1, 0, len(q) - 2)
+        t0, t1 = sample_times[i], sample_times[i+1]
+        u = np.clip((times - t0) / (t1 - t0), 0, 1)[:, None]
+        q0, q1 = q[i], q[i+1]
+        d = np.sum(q0 * q1, axis=1, keepdims=True)
+        q1 = np.where(d < 0, -q1, q1)
+        theta = arccos(np.clip(np.abs(d), 0, 1))
+        sin_theta = sin(theta)
+        small = sin_theta < 1e-9
+        with np.errstate(divide="ignore", invalid="ignore"):
+            a = np.where(small, 1 - u, sin((1 - u) * theta) / sin_theta)
+            b = np.where(small, u, sin(u * theta) / sin_theta)
+        return Rotations(quaternions=a*q0 + b*q1)
+
+def quaternion_matrices(q):
+    """(K,3,3) rotation matrices of (K,4) quaternions given as (w, x, y, z)."""
+    q = normalize_rows(np.reshape(q, (-1, 4)))
+    w, x, y, z = q.T
+    return np.stack([
+        np.stack([1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)], axis=-1),
+        np.stack([2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)], axis=-1),
+        np.stack([2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)], axis=-1),
+        ], axis=-2)
+
+def matrix_quaternions(R):
+    """(K,4) quaternions (w, x, y, z), with w >= 0, of (K,3,3) rotation matrices.
+
+    Each is computed from whichever of w, x, y, z is largest, which keeps
+    the division well conditioned.
+    """
+    R = np.reshape(R, (-1, 3, 3))
+    t = np.trace(R, axis1=1, axis2=2)
+    diag = np.stack([t, R[:, 0, 0], R[:, 1, 1], R[:, 2, 2]], axis=1)
+    k = np.argmax(diag, axis=1)
+    # Differences of the off-diagonal pairs give w times x, y, z; their
+    # sums give the products xy, xz and yz.
+    d = np.stack([R[:, 2, 1] - R[:, 1, 2], R[:, 0, 2] - R[:, 2, 0], R[:, 1, 0] - R[:, 0, 1]], axis=1)
+    pairs = {(0, 1): R[:, 1, 0] + R[:, 0, 1], (0, 2): R[:, 0, 2] + R[:, 2, 0],
+            (1, 2): R[:, 2, 1] + R[:, 1, 2]}
+    q = np.empty((len(R), 4))
+    m = k == 0
+    r = np.sqrt(1 + t[m])
+    q[m] = np.column_stack([r, d[m] / r[:, None]]) / 2
+    for i in range(3):
+        m = k == i + 1
+        r = np.sqrt(np.maximum(1 + 2*diag[m, i + 1] - t[m], 0))
+        q[m, 0] = d[m, i] / r / 2
+        q[m, i + 1] = r / 2
+        for j in {0, 1, 2} - {i}:
+            q[m, j + 1] = pairs[min(i, j), max(i, j)][m] / r / 2
+    return q * np.where(q[:, :1] < 0, -1, 1)
+
+def quaternion_products(p, q):
+    """Hamilton products p*q of broadcastable (...,4) quaternions."""
+    p = np.asarray(p, dtype=float)
+    q = np.asarray(q, dtype=float)
+    pw, pv = p[..., :1], p[..., 1:]
+    qw, qv = q[..., :1], q[..., 1:]
+    w = pw*qw - np.sum(pv*qv, axis=-1, keepdims=True)
+    v = pw*qv + qw*pv + np.cross(pv, qv)
+    return np.concatenate([w, v], axis=-1)
+
+def attitude_matrices(attitudes):
+    """(K,3,3) matrices from Rotations, (3,3) matrices or (4,) quaternions."""
+    return Rotations.from_attitudes(attitudes).matrices
+
+def points_are_inside_triangles(points, matrices):
+    """Whether directions lie inside spherical triangles given by (...,3,3)
+    vertex-column matrices, broadcasting points (...,3) against them.
+
+    A direction is inside when its weights in the vertex basis are all
+    non-negative, i.e. it is on the inner side of each edge's great circle.
+    """
+    points = np.asarray(points)
+    shape = np.broadcast_shapes(points.shape, np.shape(matrices)[:-1])
+    points = np.broadcast_to(points, shape)
+    matrices = np.broadcast_to(matrices, shape + (3,))
+    a = np.linalg.solve(matrices, points[..., None])[..., 0]
+    return np.all(a >= 0, axis=-1)
 
 def point_is_inside_triangle(point, triangle):
-    print("Here!")
-    M = triangle.point_matrix
-    p = point.vector
-    a = np.linalg.inv(M) @ p
-    lam = 1/sum(a)
-    return (lam > 0)
+    return bool(points_are_inside_triangles(point.vector, triangle.point_matrix))
@@ -0,0 +1,123 @@
+'''
+photometry.py. Visualize the photometric output of a Wavefront obj. model.
+Copyright (C) 2020  Drew Allen McNeely
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import numpy as np
+from numpy import pi, sqrt, cos, sin, arccos, arctan2
+
+from geometry import IndexedIcoSphere, as_vectors, normalize_rows
+
+def harmonic_count(degree): return (degree + 1)**2
+
+def real_harmonics(degree, directions):
+    """Orthonormal real spherical harmonics up to degree at (N,3) directions.
+
+    Returns an (N, (degree+1)**2) array with Y_lm in column l*l + l + m.
+    """
+    from scipy.special import lpmv, gammaln
+
+    v = normalize_rows(as_vectors(directions))
+    theta = arccos(np.clip(v[:, 2], -1, 1))
+    phi = arctan2(v[:, 1], v[:, 0])
+    x = cos(theta)
+
+    Y = np.empty((len(v), harmonic_count(degree)))
+    for l in range(degree + 1):
+        for m in range(l + 1):
+            K = sqrt((2*l + 1) / (4*pi) * np.exp(gammaln(l - m + 1) - gammaln(l + m + 1)))
+            P = K * lpmv(m, l, x)
+            if m == 0:
+                Y[:, l*l + l] = P
+            else:
+                Y[:, l*l + l + m] = sqrt(2) * P * cos(m*phi)
+                Y[:, l*l + l - m] = sqrt(2) * P * sin(m*phi)
+    return Y
+
+class HarmonicScatter:
+    """Truncated real spherical harmonic expansion of scatter(L, V).
+
+    scatter(L, V) ~ sum_ij Y_i(L) coefficients[i, j] Y_j(V), with the
+    coefficients found by quadrature over the face barycenters of an
+    icosphere, weighted by the faces' solid angles. The evaluation cost
+    depends only on the degree, not on the facet count of the model.
+
+    max_error and rms_error compare the expansion with the exact model on
+    the quadrature grid; relative_error is the ratio of the L2 norms of
+    the residual and of the model there. They measure the truncation
+    error, which is small for smooth (Lambertian, low-alpha) materials and
+    large for sharp specular lobes.
+    """
+    def __init__(self, degree, coefficients,
+            max_error=np.nan, rms_error=np.nan, relative_error=np.nan):
+        self.degree = int(degree)
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.max_error = float(max_error)
+        self.rms_error = float(rms_error)
+        self.relative_error = float(relative_error)
+
+    @classmethod
+    def fit(cls, model, degree=4, level=3):
+        sphere = IndexedIcoSphere.icosahedron().divided(level)
+        points = sphere.barycenters
+        w = sphere.solid_angles
+        S = model.scatter_many(points, points)
+        Y = real_harmonics(degree, points)
+        Yw = Y * w[:, None]
+        C = Yw.T @ S @ Yw
+
+        error = Y @ C @ Y.T - S
+        W = np.outer(w, w)
+        return cls(degree, C,
+                max_error=np.abs(error).max(),
+                rms_error=sqrt(np.sum(W*error**2) / W.sum()),
+                relative_error=sqrt(np.sum(W*error**2) / np.sum(W*S**2)))
+
+    @property
+    def size(self): return self.coefficients.size
+
+    def __call__(self, light_directions, viewer_directions):
+        """Paired scatter for (K,3) light and viewer directions."""
+        YL = real_harmonics(self.degree, light_directions)
+        YV = real_harmonics(self.degree, viewer_directions)
+        return np.einsum("ki,ij,kj->k", YL, self.coefficients, YV)
+
+    def scatter_many(self, light_directions, viewer_directions, paired=False):
+        if paired: return self(light_directions, viewer_directions)
+        YL = real_harmonics(self.degree, light_directions)
+        YV = real_harmonics(self.degree, viewer_directions)
+        return YL @ self.coefficients @ YV.T
+
+    def total_scatter_many(self, viewer_directions):
+        return self(viewer_directions, viewer_directions)
+
+    def scatter(self, light_direction, viewer_direction):
+        return self(as_vectors(light_direction), as_vectors(viewer_direction))[0]
+
+    def total_scatter(self, viewer_direction):
+        return self.scatter(viewer_direction, viewer_direction)
+
+    def save(self, path):
+        np.savez(path, degree=self.degree, coefficients=self.coefficients,
+                max_error=self.max_error, rms_error=self.rms_error,
+                relative_error=self.relative_error)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["degree"], f["coefficients"],
+                    f["max_error"], f["rms_error"], f["relative_error"])
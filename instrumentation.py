@@ -0,0 +1,135 @@
+'''
+photometry.py. Visualize the photometric output of a Wavefront obj. model.
+Copyright (C) 2020  Drew Allen McNeely
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import cProfile
+import csv
+import json
+import os
+import time
+from pathlib import Path
+
+# Named stage timers and counters for the photometry pipeline.
+#
+# Instrumentation is off unless enable() is called or PHOTOMETRY_PROFILE
+# names a report file. While off, stage() hands back one shared no-op
+# context manager and count() returns after a single test, so the hooks
+# left in the hot paths cost nothing measurable. A stage entered again
+# while it is already open, such as sphere() inside a caller's
+# "subdivision" stage, is timed and counted once, by the outer one.
+
+enabled = False
+report_path = None
+profile_stage = None
+
+timers = {}
+counters = {}
+profiles = {}
+_open = set()
+
+# Rates reported as counter / stage seconds.
+rates = {
+    "facets_per_second": ("facet_evaluations", "scatter"),
+    "directions_per_second": ("directions", "scatter"),
+    }
+
+class _NullStage:
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+
+_null_stage = _NullStage()
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+        self.profiler = None
+
+    def __enter__(self):
+        if self.name == profile_stage:
+            self.profiler = profiles.setdefault(self.name, cProfile.Profile())
+            self.profiler.enable()
+        _open.add(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        _open.discard(self.name)
+        if self.profiler is not None: self.profiler.disable()
+        t = timers.setdefault(self.name, [0.0, 0])
+        t[0] += elapsed
+        t[1] += 1
+        return False
+
+def stage(name):
+    """Context manager timing the named stage when instrumentation is on."""
+    if not enabled or name in _open: return _null_stage
+    return _Stage(name)
+
+def count(name, n=1):
+    if not enabled: return
+    counters[name] = counters.get(name, 0) + n
+
+def enable(path=None, stage=None):
+    """Turn instrumentation on, optionally running cProfile over one stage.
+
+    path is where write_report() goes by default; a .csv suffix selects
+    CSV, anything else JSON.
+    """
+    global enabled, report_path, profile_stage
+    enabled = True
+    report_path = path
+    profile_stage = stage
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    timers.clear()
+    counters.clear()
+    profiles.clear()
+
+def report():
+    stages = {name: {"seconds": t[0], "calls": t[1]} for name, t in timers.items()}
+    derived = {}
+    for rate, (counter, name) in rates.items():
+        if counter in counters and timers.get(name, [0])[0] > 0:
+            derived[rate] = counters[counter] / timers[name][0]
+    return {"stages": stages, "counters": dict(counters), "rates": derived}
+
+def write_report(path=None):
+    """Write the report as JSON or CSV, and any stage profile as .prof."""
+    path = Path(path or report_path)
+    r = report()
+    if path.suffix == ".csv":
+        with open(path, "w", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["kind", "name", "value", "calls"])
+            for name, s in r["stages"].items(): w.writerow(["stage", name, s["seconds"], s["calls"]])
+            for name, v in r["counters"].items(): w.writerow(["counter", name, v, ""])
+            for name, v in r["rates"].items(): w.writerow(["rate", name, v, ""])
+    else:
+        with open(path, "w") as f:
+            json.dump(r, f, indent=2)
+    for name, profiler in profiles.items():
+        profiler.dump_stats(str(path.with_name(path.stem + "-" + name + ".prof")))
+    return path
+
+if os.environ.get("PHOTOMETRY_PROFILE"):
+    enable(os.environ["PHOTOMETRY_PROFILE"], os.environ.get("PHOTOMETRY_PROFILE_STAGE"))
@@ -0,0 +1,61 @@
+'''
+photometry.py. Visualize the photometric output of a Wavefront obj. model.
+Copyright (C) 2020  Drew Allen McNeely
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import numpy as np
+from itertools import islice
+
+from geometry import Rotations
+
+# An epoch is (time, sun_direction, observer_direction, attitude).
+# Sun and observer directions point from the body towards the sun and the
+# observer in the inertial frame. The attitude rotates body-frame vectors
+# into the inertial frame and may be a Rotation, a 3x3 matrix or a
+# (w, x, y, z) quaternion. The attitudes of light_curve_arrays may also be
+# a geometry.Rotations stack, for instance one interpolated with
+# Rotations.slerp from sparser attitude samples.
+
+def to_body_frame(attitudes, directions):
+    """Rotate (K,3) inertial directions into the body frames of K attitudes."""
+    return Rotations.from_attitudes(attitudes).apply_inverse(directions)
+
+def evaluate_epochs(model, times, sun_directions, observer_directions, attitudes):
+    L = to_body_frame(attitudes, sun_directions)
+    V = to_body_frame(attitudes, observer_directions)
+    return np.asarray(times), model.scatter_many(L, V, paired=True)
+
+def light_curve_arrays(model, times, sun_directions, observer_directions, attitudes,
+        chunk_size=4096):
+    """Yield (times, brightness) chunks for epochs given as parallel arrays."""
+    for i in range(0, len(times), chunk_size):
+        c = slice(i, i+chunk_size)
+        yield evaluate_epochs(model,
+                times[c], sun_directions[c], observer_directions[c], attitudes[c])
+
+def light_curve(model, epochs, chunk_size=4096):
+    """Yield (times, brightness) chunks for an iterable of epochs.
+
+    The iterable is consumed chunk_size epochs at a time, so it can be a
+    generator over an arbitrarily long pass.
+    """
+    epochs = iter(epochs)
+    while True:
+        chunk = list(islice(epochs, chunk_size))
+        if not chunk: return
+        times, suns, observers, attitudes = zip(*chunk)
+        yield evaluate_epochs(model, times, suns, observers, attitudes)
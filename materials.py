@@ -17,11 +17,63 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
-from numpy import pi
+import numpy as np
+from numpy import pi, cos, sin, arccos, clip
 
 class Material:
-    """This class represents a material as a whole."""
-    pass
+    """This class represents a material as a whole.
+
+    It holds the MaterialProperty read by the reflectivity laws, the share
+    of reflection that is diffuse, and the (diffuse, specular) law pair.
+    """
+    def __init__(self,
+            name="",
+            material_property=None,
+            diffuse_fraction=0.5,
+            diffuse_law="lambert_diffuse",
+            specular_law="blinn_phong_specular"
+            ):
+        self.name = name
+        self.material_property = material_property or MaterialProperty()
+        self.diffuse_fraction = diffuse_fraction
+        self.diffuse_law = diffuse_law
+        self.specular_law = specular_law
+
+    @property
+    def laws(self): return (law_name(self.diffuse_law), law_name(self.specular_law))
+
+    @classmethod
+    def from_mtl(cls, name, statements):
+        """Material from the statements of a .mtl entry (see wavefront.load_mtl).
+
+        The means of the Kd and Ks colours are the diffuse and specular
+        reflectances. The specular law is weighted by Ks itself (capped at
+        1), and the diffuse law by the rest, 1 - Ks, with rho chosen so
+        that the diffuse term is Kd/pi. Ns is the exponent of N.H in the
+        highlight, which blinn_phong_specular raises to 4*alpha.
+        Illumination models 0 and 1 have no highlight and are purely
+        diffuse, with rho = Kd. Values that are missing keep the MaterialProperty and
+        Facet defaults.
+        """
+        mat = MaterialProperty()
+        fraction = 0.5
+        kd = _reflectance(statements.get("Kd"))
+        ks = _reflectance(statements.get("Ks"))
+        if kd is not None or ks is not None:
+            kd, ks = kd or 0.0, min(ks or 0.0, 1.0)
+            fraction = 1 - ks
+            mat.rho = kd / fraction if fraction > 0 else 0.0
+        if isinstance(statements.get("Ns"), float):
+            mat.alpha = statements["Ns"] / 4
+        if statements.get("illum") in (0, 1):
+            if kd is not None: mat.rho = kd
+            fraction = 1.0
+        return cls(name, mat, fraction)
+
+def _reflectance(value):
+    """Mean of an RGB reflectance statement, None if absent or not numeric."""
+    if value is None or isinstance(value, str): return None
+    return float(np.mean(value))
 
 
 class MaterialProperty:
@@ -38,6 +90,12 @@ class MaterialProperty:
         self.rho=rho
         self.alpha=alpha
 
+def angle(p1, p2): return arccos(clip(p1.dot(p2), -1, 1))
+
+def sphere_ball_area(radius):
+    """Area of a spherical cap of angular radius on the unit sphere."""
+    return 2*pi*(1 - cos(radius))
+
 # Assume a material object has whatever parameter
 # that is specified by the model.
 
@@ -87,19 +145,17 @@ def ashikhmin_shirley_diffuse(mat, geom):
 # Specular reflectivity laws
 
 def spec_helper(mat, geom, ret_fun):
-    if geom.V == geom.R: return ret_fun(mat, geom)
+    if np.isclose(geom.V.dot(geom.R), 1): return ret_fun(mat, geom)
     else: return 0
 
 def perfect_specular(mat, geom):
     return spec_helper(mat, geom, lambda m,g: 1)
 
 def fresnel_perfect_specular(mat, geom):
-    if geom.V == geom.R: return mat.F_0
-    else: return 0
+    return spec_helper(mat, geom, lambda m,g: m.F_0)
 
 def wetterer_perfect_specular(mat, geom):
-    if geom.V == geom.R: return mat.F_0 / geom.mu_i
-    else: return 0
+    return spec_helper(mat, geom, lambda m,g: m.F_0 / g.mu_i)
 
 
 def lobe_helper(mat, geom, ret_fun):
@@ -123,7 +179,7 @@ def wetterer_lobe_specular(mat, geom):
 
 
 def phong_specular(mat, geom):
-    return geom.R.dot(geom.V) ** mat.alpha
+    return max(geom.R.dot(geom.V), 0) ** mat.alpha
 
 def blinn_phong_specular(mat, geom):
     alphaprime = 4*mat.alpha
@@ -149,6 +205,128 @@ def ashikhmin_shirley_diffuse(mat, geom):
     pass
 
 
+# Array-native reflectivity laws
+#
+# These mirror the scalar laws above, but take a ReflectionCosines object
+# whose attributes are broadcastable arrays (facets on the last axis), and a
+# material whose attributes are per-facet parameter arrays. They are
+# registered in array_laws under the name of the scalar law they replace,
+# so Facet.diffuse_law and Facet.specular_law select them by name.
+
+class ReflectionCosines:
+    def __init__(self, NL, NV, LV):
+        self.NL = NL
+        self.NV = NV
+        self.LV = LV
+
+    @property
+    def mu_0(self): return self.NL
+    mu_i = mu_0
+
+    @property
+    def mu(self): return self.NV
+    mu_r = mu
+
+    @property
+    def NH(self):
+        norm_h = np.sqrt(np.maximum(2 + 2*self.LV, 0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(norm_h > 0, (self.NL + self.NV) / norm_h, 0)
+
+    @property
+    def RV(self): return 2*self.NL*self.NV - self.LV
+
+    @property
+    def theta_i(self): return arccos(clip(self.NL, -1, 1))
+    @property
+    def theta_r(self): return arccos(clip(self.NV, -1, 1))
+
+array_laws = {}
+
+def array_law(scalar_law):
+    """Register the decorated function as the array version of scalar_law."""
+    def register(f):
+        array_laws[scalar_law.__name__] = f
+        return f
+    return register
+
+@array_law(lambert_diffuse)
+def lambert_diffuse_array(mat, cosines):
+    return mat.rho / pi
+
+@array_law(irradiance_lambert_diffuse)
+def irradiance_lambert_diffuse_array(mat, cosines):
+    return mat.rho * mat.E_0 / pi
+
+array_laws["phong_diffuse"] = lambert_diffuse_array
+
+@array_law(oren_nayar_diffuse)
+def oren_nayar_diffuse_array(mat, cosines):
+    ti = cosines.theta_i
+    tr = cosines.theta_r
+    sigma = mat.sigma
+    A = 1 -0.5* sigma**2 / (sigma**2 + 0.33)
+    B = 0.45 * sigma**2 / (sigma**2 + 0.09)
+    alpha = np.maximum(ti, tr)
+    beta = np.minimum(ti, tr)
+    bracket = A + (B*np.maximum(0, cos(ti-tr))*sin(alpha)*cos(beta))
+    return mat.rho / pi * mat.E_0 * bracket
+
+def perfect_specular_mask(cosines): return np.isclose(cosines.RV, 1)
+
+@array_law(perfect_specular)
+def perfect_specular_array(mat, cosines):
+    return np.where(perfect_specular_mask(cosines), 1.0, 0.0)
+
+@array_law(fresnel_perfect_specular)
+def fresnel_perfect_specular_array(mat, cosines):
+    return np.where(perfect_specular_mask(cosines), mat.F_0, 0.0)
+
+@array_law(wetterer_perfect_specular)
+def wetterer_perfect_specular_array(mat, cosines):
+    mask = perfect_specular_mask(cosines)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(mask, mat.F_0 / cosines.mu_i, 0.0)
+
+def lobe_mask(mat, cosines): return cosines.RV > cos(mat.lobe_radius)
+
+@array_law(crappy_lobe_specular)
+def crappy_lobe_specular_array(mat, cosines):
+    return np.where(lobe_mask(mat, cosines), 1.0, 0.0)
+
+@array_law(lobe_specular)
+def lobe_specular_array(mat, cosines):
+    value = 1 / sphere_ball_area(mat.lobe_radius)
+    return np.where(lobe_mask(mat, cosines), value, 0.0)
+
+@array_law(wetterer_lobe_specular)
+def wetterer_lobe_specular_array(mat, cosines):
+    value = mat.F_0 / sphere_ball_area(mat.lobe_radius)
+    return np.where(lobe_mask(mat, cosines), value, 0.0)
+
+@array_law(phong_specular)
+def phong_specular_array(mat, cosines):
+    return clip(cosines.RV, 0, None) ** mat.alpha
+
+@array_law(blinn_phong_specular)
+def blinn_phong_specular_array(mat, cosines):
+    return clip(cosines.NH, 0, None) ** (4*mat.alpha)
+
+laws = {name: globals()[name] for name in array_laws}
+
+def resolve_law(law):
+    """Scalar reflectivity law given by name or function."""
+    if isinstance(law, str): return laws[law]
+    else: return law
+
+def law_name(law):
+    """Registry name of a reflectivity law given by name or function."""
+    name = law if isinstance(law, str) else law.__name__
+    if name not in array_laws:
+        raise KeyError("no array-native version of reflectivity law " + repr(name))
+    return name
+
+
 ## Scattering Laws
 
 def wavefront(Kd, N, L, Ks, H, Ns):
@@ -19,13 +19,21 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import numpy as np
 from numpy import dot
+from copy import copy
+from functools import cached_property
 
-from geometry import SpherePoint
-from materials import MaterialProperty, lambert_diffuse, blinn_phong_specular
+from geometry import SpherePoint, as_vector, as_vectors, normalize_rows
+from materials import Material, MaterialProperty, lambert_diffuse, blinn_phong_specular
+from materials import ReflectionCosines, array_laws, law_name, resolve_law
 
-import pymesh as pm
+from lightcurves import light_curve, light_curve_arrays
+from shadowing import Shadowing
+from baking import bake
+from harmonics import HarmonicScatter
+from wavefront import ObjMesh, load_obj, component_labels, material_libraries
+from cache import cached
+from instrumentation import stage, count
 
-from itertools import islice, repeat
 
 class ReflectionGeometry:
     def __init__(self, light_direction, viewer_direction, surface_normal):
@@ -109,8 +117,8 @@ class Facet:
         self.material_property = material_property
         self.diffuse_fraction = diffuse_fraction
         self.specular_fraction = 1-self.diffuse_fraction
-        self.diffuse_law = diffuse_law
-        self.specular_law = specular_law
+        self.diffuse_law = resolve_law(diffuse_law)
+        self.specular_law = resolve_law(specular_law)
 
     @property
     def k_d(self): return self.diffuse_fraction
@@ -159,58 +167,471 @@ class Model:
     def total_scatter(self, viewer_direction):
         return self.scatter(viewer_direction, viewer_direction)
 
-class WavefrontModel:
-    def __init__(self, mesh):
-        attributes = [
-                "face_area",
-                "face_normal"
-                ]
-        for a in attributes:
-            mesh.add_attribute(a)
+    def scatter_many(self, light_directions, viewer_directions, paired=False):
+        model = FacetArray.from_model(self)
+        return model.scatter_many(light_directions, viewer_directions, paired)
+
+    def total_scatter_many(self, viewer_directions):
+        return self.scatter_many(viewer_directions, viewer_directions, paired=True)
+
+class FacetArray:
+    """Structure-of-arrays counterpart of Model.
+
+    Areas, unit normals, diffuse fractions and material indices are kept in
+    contiguous arrays so that the Facet scattering law is evaluated for every
+    facet in one pass. Materials are shared MaterialProperty objects looked up
+    through material_index, and reflectivity laws are (diffuse, specular)
+    pairs of names from materials.array_laws looked up through law_index.
+
+    Scattering is evaluated one (law, material) group at a time, with the
+    group's MaterialProperty passed to the laws as scalars. Groups are
+    slices when the facets are ordered by group (see grouped), so
+    multi-material models cost about as much as single-material ones.
+
+    With dtype=np.float32 (see astype) the facet arrays are stored in
+    single precision and the indices as int16, 24 instead of 56 bytes per
+    facet, and cosines and laws are evaluated in single precision while
+    sums over facets accumulate in float64. Cosines then carry relative
+    errors of about 1e-7, and Blinn-Phong terms N.H**(4 alpha) about
+    4 alpha times that, so brightness typically agrees with double
+    precision to 1e-6 relative, or 1e-5 for sharp glints (alpha ~ 100).
+    """
+    # Upper bound on direction-facet products held in memory at once.
+    chunk_elements = 2**21
+    # Optional shadowing.Shadowing giving per-direction occlusion masks.
+    shadowing = None
+
+    def __init__(self,
+            areas,
+            normals,
+            diffuse_fractions=0.5,
+            materials=(MaterialProperty(),),
+            material_index=0,
+            laws=(("lambert_diffuse", "blinn_phong_specular"),),
+            law_index=0,
+            normalize=True,
+            dtype=float
+            ):
+        """Arrays that are already contiguous, of the right type and (with
+        normalize=False) hold unit normals are used without copying, so
+        memory-mapped arrays stay shared."""
+        self.dtype = np.dtype(dtype)
+        areas = np.ascontiguousarray(areas, dtype=self.dtype)
+        shape = areas.shape
+        normals = np.reshape(normals, (-1, 3))
+        if normalize: normals = normalize_rows(normals)
+        self.areas = areas
+        self.normals = np.ascontiguousarray(normals, dtype=self.dtype)
+        self.diffuse_fractions = np.ascontiguousarray(
+                np.broadcast_to(np.asarray(diffuse_fractions, dtype=self.dtype), shape))
+        self.materials = list(materials)
+        self.laws = [(law_name(d), law_name(s)) for d,s in laws]
+        compact = self.dtype.itemsize < 8 and max(len(self.materials), len(self.laws)) < 2**15
+        index = np.int16 if compact else np.intp
+        self.material_index = np.ascontiguousarray(
+                np.broadcast_to(np.asarray(material_index, dtype=index), shape))
+        self.law_index = np.ascontiguousarray(
+                np.broadcast_to(np.asarray(law_index, dtype=index), shape))
+
+    def __len__(self): return len(self.areas)
 
+    @classmethod
+    def from_facets(cls, facets):
+        materials = []
+        material_index = []
+        laws = []
+        law_index = []
+        seen = {}
+        for f in facets:
+            m = f.material_property
+            if id(m) not in seen:
+                seen[id(m)] = len(materials)
+                materials.append(m)
+            material_index.append(seen[id(m)])
+
+            law = (law_name(f.diffuse_law), law_name(f.specular_law))
+            if law not in laws: laws.append(law)
+            law_index.append(laws.index(law))
+
+        areas = [f.area for f in facets]
+        normals = [f.normal_direction.vector for f in facets]
+        fractions = [f.diffuse_fraction for f in facets]
+        return cls(areas, normals, fractions, materials, material_index, laws, law_index)
+
+    @classmethod
+    def from_model(cls, model): return cls.from_facets(model.facets)
+
+    @classmethod
+    def from_mesh(cls, mesh, dtype=float):
+        """Build directly from the pymesh face_area and face_normal attributes.
+
+        Meshes read by wavefront.load_obj also name each face's usemtl
+        material; those are built from the .mtl entries with
+        Material.from_mtl, and faces that come before any usemtl get the
+        default Material().
+        """
+        for a in ["face_area", "face_normal"]:
+            mesh.add_attribute(a)
         areas = mesh.get_attribute("face_area")
-        normals = mesh.get_attribute("face_normal")
-        length_to_split = repeat(3, len(areas))
-        Inputt = iter(normals)
-        normals = [list(islice(Inputt, elem)) for elem in length_to_split]
+        normals = mesh.get_attribute("face_normal").reshape(-1, 3)
+        names = getattr(mesh, "material_names", None)
+        if not names: return cls(areas, normals, normalize=False, dtype=dtype)
+        materials = [Material.from_mtl(n, mesh.materials.get(n, {})) for n in names]
+        material_index = np.asarray(mesh.face_material)
+        if np.any(material_index < 0):
+            material_index = np.where(material_index < 0, len(materials), material_index)
+            materials.append(Material())
+        return cls.from_materials(areas, normals, materials, material_index,
+                normalize=False, dtype=dtype)
+
+    @classmethod
+    def from_materials(cls, areas, normals, materials, material_index=0, normalize=True,
+            dtype=float):
+        """Facets whose diffuse fraction and laws come from a list of Materials."""
+        laws = []
+        for m in materials:
+            if m.laws not in laws: laws.append(m.laws)
+        material_laws = np.array([laws.index(m.laws) for m in materials], dtype=np.intp)
+        fractions = np.array([m.diffuse_fraction for m in materials], dtype=float)
+        material_index = np.asarray(material_index, dtype=np.intp)
+        return cls(areas, normals,
+                fractions[material_index],
+                [m.material_property for m in materials], material_index,
+                laws, material_laws[material_index],
+                normalize=normalize, dtype=dtype)
 
-        normal_directions = [SpherePoint.from_list(n) for n in normals]
+    @property
+    def k_d(self): return self.diffuse_fractions
+    d = k_d
 
-        facets = [Facet(area=a, normal_direction=n) for a,n in zip(areas, normal_directions)]
-        model = Model(facets)
+    @property
+    def k_s(self): return 1 - self.diffuse_fractions
+    s = k_s
+
+    @property
+    def total_area(self): return self.areas.sum()
+
+    def merged(self, tolerance=1e-5):
+        """Facets with equal normals, materials, laws and diffuse fractions
+        summed by area into one facet each.
+
+        The scattering law is linear in area, so merging is exact for
+        identical normals. Normals are compared after rounding to multiples
+        of tolerance, and each merged facet takes the area-weighted mean
+        normal of its group.
+        """
+        # Law and material lead the keys, so the merged facets come out grouped.
+        keys = np.column_stack([
+            self.law_index,
+            self.material_index,
+            np.round(self.normals / tolerance),
+            np.round(self.diffuse_fractions / tolerance),
+            ])
+        _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+        areas = np.bincount(inverse, weights=self.areas)
+        normals = np.stack([np.bincount(inverse, weights=self.areas * n)
+            for n in self.normals.T], axis=-1)
+        # Zero-area groups keep the normal of their first facet.
+        normals[areas == 0] = self.normals[first[areas == 0]]
+
+        merged = FacetArray(areas, normals,
+                self.diffuse_fractions[first],
+                self.materials, self.material_index[first],
+                self.laws, self.law_index[first], dtype=self.dtype)
+        merged.chunk_elements = self.chunk_elements
+        return merged
+
+    def subset(self, facets):
+        """FacetArray of the facets selected by an index array, mask or slice.
+
+        Slices give views of the facet arrays. A shadowing model is rebuilt
+        over the selected triangles, so removed facets no longer cast shadows.
+        """
+        model = FacetArray(self.areas[facets], self.normals[facets],
+                self.diffuse_fractions[facets],
+                self.materials, self.material_index[facets],
+                self.laws, self.law_index[facets],
+                normalize=False, dtype=self.dtype)
+        model.chunk_elements = self.chunk_elements
+        if self.shadowing is not None:
+            model.shadowing = self.shadowing.subset(facets)
+        return model
+
+    def astype(self, dtype):
+        """This model with its facet arrays stored as dtype (float32 or float64)."""
+        model = FacetArray(self.areas, self.normals, self.diffuse_fractions,
+                self.materials, self.material_index,
+                self.laws, self.law_index,
+                normalize=False, dtype=dtype)
+        model.chunk_elements = self.chunk_elements
+        model.shadowing = self.shadowing
+        return model
+
+    def parameter(self, name):
+        """Per-facet array of a MaterialProperty attribute."""
+        values = np.array([getattr(m, name) for m in self.materials], dtype=float)
+        return values[self.material_index]
+
+    @property
+    def group_keys(self):
+        """Per-facet key ordering facets by law pair, then material."""
+        return self.law_index.astype(np.intp) * len(self.materials) + self.material_index
+
+    def grouped(self):
+        """This model with each (law, material) group contiguous, and the
+        indices of its facets in this one. Already grouped models are
+        returned as they are."""
+        keys = self.group_keys
+        if np.all(keys[1:] >= keys[:-1]): return self, np.arange(len(self))
+        order = np.argsort(keys, kind="stable")
+        return self.subset(order), order
+
+    @cached_property
+    def groups(self):
+        """(facets, diffuse_law, specular_law, material) of each (law,
+        material) group. facets is a slice when the group is contiguous
+        and an index array otherwise."""
+        keys = self.group_keys
+        values, first, counts = np.unique(keys, return_index=True, return_counts=True)
+        contiguous = np.all(keys[1:] >= keys[:-1])
+        groups = []
+        for key, start, n in zip(values, first, counts):
+            law, material = divmod(int(key), len(self.materials))
+            if contiguous: facets = slice(int(start), int(start + n))
+            else: facets = np.flatnonzero(keys == key)
+            d, s = self.laws[law]
+            groups.append((facets, array_laws[d], array_laws[s], self.materials[material]))
+        return groups
+
+    def law_groups(self): return iter(self.groups)
+
+    def reflectivity_law(self, cosines, group):
+        facets, diffuse_law, specular_law, mat = group
+        Rd = diffuse_law(mat, cosines)
+        Rs = specular_law(mat, cosines)
+        d = self.diffuse_fractions[facets]
+        return d*Rd + (1 - d)*Rs
+
+    def scattering_law(self, mu_0, mu, cos_lv, group):
+        """Per-facet scattering of a law group from the cosines N.L, N.V and L.V.
+
+        The remaining cosines (N.H, R.V) follow from these, so no halfway or
+        reflected vectors have to be formed. Facet axes are last, so mu_0 and
+        mu may be any stack of (..., F) arrays with cos_lv broadcasting
+        against them.
+        """
+        cosines = ReflectionCosines(mu_0, mu, cos_lv)
+        lit = (mu >= 0) & (mu_0 >= 0)
+        S = self.areas[group[0]] * mu * mu_0 * self.reflectivity_law(cosines, group)
+        return np.where(lit, S, 0)
+
+    def _scatter_block(self, Ls, Vs):
+        """Total scatter for broadcastable (..., 3) light and viewer stacks."""
+        Ls = Ls.astype(self.dtype, copy=False)
+        Vs = Vs.astype(self.dtype, copy=False)
+        cos_lv = np.sum(Ls * Vs, axis=-1, keepdims=True)
+        if self.shadowing is not None:
+            lit = self.shadowing.illuminated(Ls)
+            seen = self.shadowing.visible(Vs)
+        total = 0
+        for group in self.law_groups():
+            facets = group[0]
+            N = self.normals[facets]
+            mu_0 = Ls @ N.T
+            mu = Vs @ N.T
+            if self.shadowing is not None:
+                # Occluded facets scatter nothing, exactly as at grazing incidence.
+                mu_0 = np.where(lit[..., facets], mu_0, 0)
+                mu = np.where(seen[..., facets], mu, 0)
+            S = self.scattering_law(mu_0, mu, cos_lv, group)
+            total = total + S.sum(axis=-1, dtype=float)
+        return total
+
+    def scatter_many(self, light_directions, viewer_directions, paired=False):
+        """Scatter for sets of light and viewer directions.
+
+        With (M,3) lights and (N,3) viewers this returns the (M,N) matrix of
+        every combination. With paired=True both sets must have the same
+        length K and the (K,) brightness of each pair is returned. Work is
+        split into blocks of at most chunk_elements direction-facet products.
+        """
+        Ls = normalize_rows(as_vectors(light_directions))
+        Vs = normalize_rows(as_vectors(viewer_directions))
+        per_pair = max(len(self), 1)
+        with stage("scatter"):
+            if paired:
+                if len(Ls) != len(Vs):
+                    raise ValueError("paired directions must have equal length")
+                out = np.empty(len(Ls))
+                step = max(1, self.chunk_elements // per_pair)
+                for i in range(0, len(Ls), step):
+                    out[i:i+step] = self._scatter_block(Ls[i:i+step], Vs[i:i+step])
+                count("directions", len(Ls))
+                count("facet_evaluations", len(Ls) * len(self))
+                return out
+
+            out = np.empty((len(Ls), len(Vs)))
+            cols = max(1, min(len(Vs), self.chunk_elements // per_pair))
+            rows = max(1, self.chunk_elements // (per_pair * cols))
+            for i in range(0, len(Ls), rows):
+                for j in range(0, len(Vs), cols):
+                    L = Ls[i:i+rows, None, :]
+                    V = Vs[None, j:j+cols, :]
+                    out[i:i+rows, j:j+cols] = self._scatter_block(L, V)
+            count("directions", out.size)
+            count("facet_evaluations", out.size * len(self))
+            return out
+
+    def total_scatter_many(self, viewer_directions):
+        return self.scatter_many(viewer_directions, viewer_directions, paired=True)
+
+    def scatter(self, light_direction, viewer_direction):
+        L = as_vector(light_direction)
+        V = as_vector(viewer_direction)
+        return self.scatter_many(L, V, paired=True)[0]
+
+    def total_scatter(self, viewer_direction):
+        return self.scatter(viewer_direction, viewer_direction)
+
+class WavefrontModel:
+    def __init__(self, mesh, shadowing=False, merge=False, dtype=float):
+        """Facet model of a mesh.
+
+        Facets are ordered by material (see FacetArray.grouped), and
+        facet_indices gives the mesh face of each.
+
+        dtype=np.float32 stores the facet arrays in single precision (see
+        FacetArray). An ObjMesh is then compacted first (see
+        ObjMesh.compact), so its faces are kept as int32 and its face areas
+        and normals computed in single precision, and those are released
+        once the facets are built.
+
+        With merge=True, facets sharing a normal and material are merged
+        (see FacetArray.merged) and reduction_ratio records how many mesh
+        triangles each evaluated facet stands for. Shadowing needs the
+        position of every triangle, so the two cannot be combined.
+        """
+        compact = np.dtype(dtype).itemsize < 8
+        if compact and isinstance(mesh, ObjMesh): mesh.compact(dtype)
+        with stage("facets"):
+            model, order = FacetArray.from_mesh(mesh, dtype).grouped()
+        if compact:
+            order = order.astype(np.int32)
+            if isinstance(mesh, ObjMesh): mesh.clear_attributes()
+        triangles = len(model)
+        if shadowing and merge:
+            raise ValueError("merged facets have no position to cast shadow rays from")
+        if shadowing:
+            model.shadowing = Shadowing(mesh.vertices, mesh.faces[order], model.normals)
+        if merge:
+            model = model.merged()
+        self.reduction_ratio = triangles / max(len(model), 1)
+        self.merged = merge
+        self.facet_indices = order
+        self._labels = None
 
         self.mesh = mesh
-        self.areas = areas
-        self.normals = normal_directions
+        self.areas = model.areas
+        self.normals = model.normals
         self.facet_model = model
 
     @classmethod
-    def from_path(cls, path):
-        mesh = pm.load_mesh(str(path))
-        return cls(mesh)
+    def from_path(cls, path, shadowing=False, merge=False, loader="native", cache=False,
+            dtype=float):
+        """Load a mesh file with the native .obj reader or with pymesh.
+
+        With cache set (True for the default directory, or a directory),
+        the loaded mesh arrays are stored under the content hash of the
+        file and of the .mtl files it names, and later loads memory-map
+        them instead of parsing the file.
+        """
+        def load():
+            if loader == "native":
+                return load_obj(path)
+            else:
+                import pymesh as pm
+                return ObjMesh.from_mesh(pm.load_mesh(str(path)))
+
+        with stage("load"):
+            if cache:
+                cache_dir = None if cache is True else cache
+                build = lambda: load().to_arrays()
+                libraries = material_libraries(path) if loader == "native" else ()
+                mesh = ObjMesh.from_arrays(*cached(path, build, cache_dir, libraries,
+                    loader=loader))
+            elif loader == "native":
+                mesh = load()
+            else:
+                import pymesh as pm
+                mesh = pm.load_mesh(str(path))
+        return cls(mesh, shadowing, merge, dtype)
 
     @property
-    def total_area(self): return sum(self.areas)
+    def total_area(self): return self.facet_model.total_area
 
-    def components(self):
-        comps = pm.separate_mesh(self.mesh)
-        return [Topex(c) for c in comps]
-
-    def reduced(self, n=10):
-        components = self.components()
+    @property
+    def component_labels(self):
+        """Connected component of each facet (facets sharing a vertex connect)."""
+        if self.merged:
+            raise ValueError("merged facets do not belong to single components")
+        if self._labels is None:
+            labels = getattr(self.mesh, "component_labels", None)
+            if labels is None:
+                labels = component_labels(self.mesh.faces, len(self.mesh.vertices))
+            self._labels = np.asarray(labels)[self.facet_indices]
+        return self._labels
 
-        areas = [c.total_area for c in components]
+    @property
+    def component_areas(self):
+        return np.bincount(self.component_labels, weights=self.areas)
+
+    def subset(self, facets):
+        """Model of the selected facets, sharing the mesh of this one."""
+        model = copy(self)
+        model.facet_model = self.facet_model.subset(facets)
+        model.areas = model.facet_model.areas
+        model.normals = model.facet_model.normals
+        model.facet_indices = self.facet_indices[facets]
+        model._labels = self.component_labels[facets]
+        return model
 
-        area_tuples = zip(components, areas)
+    def components(self):
+        """One model per connected component, in label order."""
+        labels = self.component_labels
+        order = np.argsort(labels, kind="stable")
+        bounds = np.cumsum(np.bincount(labels))
+        return [self.subset(order[a:b]) for a, b in zip(np.r_[0, bounds[:-1]], bounds)]
 
-        components = sorted(area_tuples, key=itemgetter(1), reverse=True)
-        components = components[:10]
-        components = [c[0].mesh for c in components]
-        mesh = pm.merge_meshes(components)
-        return Topex(mesh)
+    def reduced(self, n=10):
+        """Model of the n components with the largest area."""
+        largest = np.argsort(self.component_areas)[::-1][:n]
+        return self.subset(np.isin(self.component_labels, largest))
 
     def scatter(self, light_direction, viewer_direction):
         return self.facet_model.scatter(light_direction, viewer_direction)
 
     def total_scatter(self, viewer_direction):
         return self.facet_model.total_scatter(viewer_direction)
+
+    def scatter_many(self, light_directions, viewer_directions, paired=False):
+        return self.facet_model.scatter_many(light_directions, viewer_directions, paired)
+
+    def total_scatter_many(self, viewer_directions):
+        return self.facet_model.total_scatter_many(viewer_directions)
+
+    def baked(self, level=None, bistatic=False):
+        """Lookup-table version of this model; see baking.bake."""
+        return bake(self.facet_model, level, bistatic)
+
+    def harmonics(self, degree=4, level=3):
+        """Spherical harmonic expansion of this model; see HarmonicScatter."""
+        return HarmonicScatter.fit(self.facet_model, degree, level)
+
+    def light_curve(self, epochs, chunk_size=4096):
+        return light_curve(self.facet_model, epochs, chunk_size)
+
+    def light_curve_arrays(self, times, sun_directions, observer_directions, attitudes,
+            chunk_size=4096):
+        return light_curve_arrays(self.facet_model,
+                times, sun_directions, observer_directions, attitudes, chunk_size)
@@ -17,23 +17,68 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
-from pathlib import Path
-import os
+import argparse
 from os.path import basename, splitext
 
-import sys
-from models import WavefrontModel
-from visualization import plot_function_triangles as plot
+import instrumentation
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Visualize the photometric output of a Wavefront .obj model.")
+    parser.add_argument("path", help="mesh file to load")
+    parser.add_argument("--level", type=int, default=4,
+        help="icosphere subdivision level (default: 4)")
+    parser.add_argument("--tol", type=float,
+        help="refine faces over which the brightness varies by more than tol")
+    parser.add_argument("--max-depth", type=int, default=7,
+        help="deepest subdivision level of refinement (default: 7)")
+    parser.add_argument("-o", "--output", action="append",
+        help=".html, .npz or .parquet file to write; may be repeated "
+             "(default: <model name>.html)")
+    parser.add_argument("--float32", action="store_true",
+        help="store coordinates and values of .npz and .parquet output in single precision")
+    parser.add_argument("--profile", metavar="REPORT",
+        default=instrumentation.report_path,
+        help="time each stage and write a .json or .csv report "
+             "(default: $PHOTOMETRY_PROFILE)")
+    parser.add_argument("--profile-stage", metavar="STAGE",
+        default=instrumentation.profile_stage,
+        help="also run cProfile over one stage (load, facets, subdivision, "
+             "geojson, mapf, scatter, html, export)")
+    args = parser.parse_args()
+    for filename in args.output or []:
+        if splitext(filename)[1] not in (".html", ".npz", ".parquet"):
+            parser.error("unknown output format " + repr(filename))
 
-    path = sys.argv[1]
-    objname = splitext(basename(path))[0]
+    if args.profile:
+        instrumentation.enable(args.profile, args.profile_stage)
 
-    model = WavefrontModel.from_path(path)
+    # Imported after enabling so that module-level stages are timed too.
+    from geometry import vectorized
+    from models import WavefrontModel
+    from visualization import sphere, plot_sphere_values
+    from instrumentation import stage
+    import export
 
-    def func(viewer_direction):
-        return model.total_scatter(viewer_direction)
+    objname = splitext(basename(args.path))[0]
 
-    filename = objname + ".html"
-    plot(func, filename)
+    model = WavefrontModel.from_path(args.path, cache=True)
+
+    func = vectorized(model.total_scatter_many)
+
+    with stage("subdivision"):
+        s = sphere(args.level)
+        if args.tol is not None:
+            s = s.refined(func, args.tol, args.max_depth - args.level)
+    with stage("mapf"):
+        values = s.mapf(func)
+
+    for filename in args.output or [objname + ".html"]:
+        if filename.endswith(".html"):
+            plot_sphere_values(s, values, filename)
+        else:
+            with stage("export"):
+                export.save(filename, s, values, args.float32)
+
+    if args.profile:
+        print("profile written to", instrumentation.write_report())
@@ -0,0 +1,252 @@
+'''
+photometry.py. Visualize the photometric output of a Wavefront obj. model.
+Copyright (C) 2020  Drew Allen McNeely
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import numpy as np
+from numpy import pi
+
+# Streaming statistics of brightness over random viewing geometries.
+#
+# ScatterSampler draws sun and observer directions uniformly over the
+# sphere, from independently scrambled Sobol sequences or plain
+# pseudo-random numbers, evaluates a model on them batch by batch and
+# folds the results into accumulators of fixed size: running moments,
+# a histogram, a relative-accuracy quantile sketch and moments per
+# phase-angle bin. Memory does not grow with the number of samples.
+
+def uniform_directions(u):
+    """Unit vectors, uniform over the sphere, from (N,2) points of [0,1)^2."""
+    z = 1 - 2*u[:, 0]
+    phi = 2*pi*u[:, 1]
+    r = np.sqrt(np.maximum(1 - z*z, 0))
+    return np.stack([r*np.cos(phi), r*np.sin(phi), z], axis=-1)
+
+class RunningStats:
+    """Count, mean and sum of squared deviations, merged batch by batch.
+
+    With shape set, each of several independent streams (such as
+    histogram bins) is tracked at once.
+    """
+    def __init__(self, shape=()):
+        self.count = np.zeros(shape)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def merge(self, count, mean, m2):
+        n = self.count + count
+        with np.errstate(divide="ignore", invalid="ignore"):
+            delta = mean - self.mean
+            self.mean = np.where(n > 0, self.mean + delta * count / n, 0)
+            self.m2 = self.m2 + m2 + np.where(n > 0, delta**2 * self.count * count / n, 0)
+        self.count = n
+
+    def update(self, x):
+        x = np.asarray(x, dtype=float).ravel()
+        if len(x) == 0: return
+        mean = x.mean()
+        self.merge(len(x), mean, np.sum((x - mean)**2))
+
+    def update_bins(self, index, x):
+        """Update stream index[i] with x[i]."""
+        size = self.count.size
+        count = np.bincount(index, minlength=size)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.where(count > 0, np.bincount(index, x, size) / count, 0)
+        m2 = np.bincount(index, (x - mean[index])**2, size)
+        self.merge(count, mean, m2)
+
+    @property
+    def variance(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)
+
+    @property
+    def std(self): return np.sqrt(self.variance)
+
+class Histogram:
+    """Counts in fixed bins, plus the counts falling below and above them."""
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=float)
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+    def update(self, x):
+        x = np.asarray(x, dtype=float).ravel()
+        self.underflow += int(np.sum(x < self.edges[0]))
+        self.overflow += int(np.sum(x > self.edges[-1]))
+        self.counts += np.histogram(x, self.edges)[0]
+
+class QuantileSketch:
+    """Quantiles with bounded relative error from logarithmic buckets.
+
+    Positive values v fall in bucket ceil(log(v)/log(gamma)), with
+    gamma = (1+a)/(1-a) for relative_accuracy a; values at or below zero
+    are counted apart. Reported quantiles are within a factor (1 +- a) of
+    the exact ones, and the number of buckets grows only with the log of
+    the range of values, not with the number of samples.
+    """
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def update(self, x):
+        x = np.asarray(x, dtype=float).ravel()
+        positive = x[x > 0]
+        self.zero_count += len(x) - len(positive)
+        self.count += len(x)
+        keys, counts = np.unique(np.ceil(np.log(positive) / np.log(self.gamma)).astype(np.int64),
+                return_counts=True)
+        for k, c in zip(keys.tolist(), counts.tolist()):
+            self.buckets[k] = self.buckets.get(k, 0) + c
+
+    def quantile(self, q):
+        """Approximate q-quantiles, q in [0, 1]."""
+        q = np.atleast_1d(np.asarray(q, dtype=float))
+        if self.count == 0: return np.full(q.shape, np.nan)
+        keys = np.array(sorted(self.buckets), dtype=np.int64)
+        cumulative = self.zero_count + np.cumsum([self.buckets[k] for k in keys.tolist()])
+        rank = q * (self.count - 1)
+        i = np.searchsorted(cumulative, rank, side="right")
+        values = 2 * self.gamma**keys / (self.gamma + 1) if len(keys) else np.zeros(0)
+        out = np.zeros(q.shape)
+        above = rank >= self.zero_count
+        out[above] = values[np.minimum(i[above], len(keys) - 1)]
+        return out
+
+class ScatterSampler:
+    """Brightness statistics of a model over random viewing geometries.
+
+    Each sample is a sun and an observer direction drawn uniformly over
+    the sphere (or a single shared one with monostatic=True), evaluated
+    with scatter_many or total_scatter_many. With method="sobol" the
+    samples come from `replicates` independently scrambled Sobol
+    sequences and the standard error of the mean is the spread of their
+    means (an estimate with replicates - 1 degrees of freedom); with
+    method="random" it is std/sqrt(n).
+
+    The brightness histogram spans hist_range, taken on the first batch
+    as [0, 1.5 * its maximum] when not given; values outside it are
+    counted as underflow/overflow. The phase angle, between the sun and
+    observer directions, is binned into phase_bins with running moments
+    per bin.
+    """
+    def __init__(self, model, monostatic=False, method="sobol", replicates=8, seed=None,
+            bins=64, hist_range=None, phase_bins=36, relative_accuracy=0.01):
+        if method not in ("sobol", "random"):
+            raise ValueError("method must be 'sobol' or 'random'")
+        self.model = model
+        self.monostatic = monostatic
+        self.method = method
+        self.dimension = 2 if monostatic else 4
+        rng = np.random.default_rng(seed)
+        if method == "sobol":
+            from scipy.stats import qmc
+            self.engines = [qmc.Sobol(self.dimension, scramble=True, seed=rng)
+                    for _ in range(replicates)]
+        else:
+            self.rng = rng
+            self.engines = [None]
+        self.replicates = RunningStats(len(self.engines))
+        self.stats = RunningStats()
+        self.bins = bins
+        self.histogram = None if hist_range is None else Histogram(np.linspace(*hist_range, bins + 1))
+        self.sketch = QuantileSketch(relative_accuracy)
+        self.phase_edges = np.linspace(0, pi, phase_bins + 1)
+        self.phase = RunningStats(phase_bins)
+
+    @property
+    def count(self): return int(self.stats.count)
+    @property
+    def mean(self): return float(self.stats.mean)
+    @property
+    def variance(self): return float(self.stats.variance)
+    @property
+    def std(self): return float(self.stats.std)
+
+    @property
+    def standard_error(self):
+        if self.method == "random":
+            return float(self.stats.std / np.sqrt(self.stats.count)) if self.count > 1 else np.inf
+        r = self.replicates
+        if np.any(r.count == 0): return np.inf
+        return float(np.std(r.mean, ddof=1) / np.sqrt(len(r.mean)))
+
+    def quantile(self, q): return self.sketch.quantile(q)
+
+    def draw(self, n):
+        """(L, V) arrays for about n samples, split evenly over the
+        replicates, in powers of two per replicate for Sobol balance."""
+        if self.method == "random":
+            u = [self.rng.random((n, self.dimension))]
+        else:
+            m = max(0, int(np.log2(max(1, n // len(self.engines)))))
+            u = [e.random_base2(m) if e.num_generated == 0 else e.random(2**m)
+                    for e in self.engines]
+        L = [uniform_directions(x[:, :2]) for x in u]
+        V = L if self.monostatic else [uniform_directions(x[:, 2:]) for x in u]
+        return L, V
+
+    def update(self, L, V):
+        """Evaluate one batch drawn per replicate and fold it in."""
+        for k, (l, v) in enumerate(zip(L, V)):
+            if self.monostatic: b = np.asarray(self.model.total_scatter_many(v), dtype=float)
+            else: b = np.asarray(self.model.scatter_many(l, v, paired=True), dtype=float)
+            self.stats.update(b)
+            self.replicates.update_bins(np.full(len(b), k), b)
+            if self.histogram is None:
+                top = 1.5 * b.max() if len(b) and b.max() > 0 else 1.0
+                self.histogram = Histogram(np.linspace(0, top, self.bins + 1))
+            self.histogram.update(b)
+            self.sketch.update(b)
+            phase = np.arccos(np.clip(np.sum(l*v, axis=1), -1, 1))
+            index = np.clip(np.searchsorted(self.phase_edges, phase, side="right") - 1,
+                    0, len(self.phase_edges) - 2)
+            self.phase.update_bins(index, b)
+
+    def run(self, target_error=None, relative=False, max_samples=2**22,
+            batch_size=2**12, min_samples=2**10):
+        """Sample until the standard error of the mean reaches target_error
+        (a fraction of the mean with relative=True) or max_samples are drawn."""
+        while self.count < max_samples:
+            self.update(*self.draw(min(batch_size, max_samples - self.count)))
+            if target_error is None or self.count < min_samples: continue
+            goal = target_error * abs(self.mean) if relative else target_error
+            if self.standard_error <= goal: break
+        return self
+
+    def summary(self, quantiles=(0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "std": self.std,
+            "standard_error": self.standard_error,
+            "quantiles": dict(zip(quantiles, self.quantile(quantiles).tolist())),
+            "histogram": {
+                "edges": self.histogram.edges.tolist() if self.histogram else [],
+                "counts": self.histogram.counts.tolist() if self.histogram else [],
+                "underflow": self.histogram.underflow if self.histogram else 0,
+                "overflow": self.histogram.overflow if self.histogram else 0},
+            "phase": {
+                "edges": self.phase_edges.tolist(),
+                "counts": self.phase.count.astype(int).tolist(),
+                "means": self.phase.mean.tolist()},
+            }
@@ -0,0 +1,366 @@
+'''
+photometry.py. Visualize the photometric output of a Wavefront obj. model.
+Copyright (C) 2020  Drew Allen McNeely
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import numpy as np
+from collections import OrderedDict
+
+from geometry import normalize_rows
+
+def dot(a, b): return a[:, 0]*b[:, 0] + a[:, 1]*b[:, 1] + a[:, 2]*b[:, 2]
+
+def cross(a, b):
+    return np.stack([
+        a[:, 1]*b[:, 2] - a[:, 2]*b[:, 1],
+        a[:, 2]*b[:, 0] - a[:, 0]*b[:, 2],
+        a[:, 0]*b[:, 1] - a[:, 1]*b[:, 0]], axis=1)
+
+def support(vertices, directions, chunk=4096):
+    """Largest d . x over the vertices x, for each of the (K,3) directions d.
+
+    The maximum is attained at a convex hull vertex, and it is found by
+    climbing the hull's edge graph from the best of a sample of its
+    vertices: a vertex no neighbour improves on is the maximum of a linear
+    function over a convex polytope. Flat or tiny vertex sets fall back to
+    comparing every vertex.
+    """
+    from scipy.spatial import ConvexHull, QhullError
+    vertices = np.asarray(vertices, dtype=float)
+    directions = np.asarray(directions, dtype=float)
+    try: hull = ConvexHull(vertices)
+    except (QhullError, ValueError):
+        return np.concatenate([(vertices @ directions[i:i+chunk].T).max(axis=0)
+            for i in range(0, len(directions), chunk)] or [np.zeros(0)])
+    points = vertices[hull.vertices]
+    index = np.empty(len(vertices), dtype=np.intp)
+    index[hull.vertices] = np.arange(len(points))
+    tris = index[hull.simplices]
+    a = tris.ravel()
+    b = np.roll(tris, -1, axis=1).ravel()
+    edges = np.unique(np.concatenate([a * len(points) + b, b * len(points) + a]))
+    neighbours = edges % len(points)
+    first = np.searchsorted(edges // len(points), np.arange(len(points) + 1))
+
+    sample = np.arange(0, len(points), max(1, len(points) // 256))
+    current = sample[np.argmax(directions @ points[sample].T, axis=1)]
+    value = np.einsum("ij,ij->i", directions, points[current])
+    active = np.arange(len(directions))
+    while len(active):
+        degree = first[current[active] + 1] - first[current[active]]
+        pairs = np.repeat(active, degree)
+        offsets = np.arange(degree.sum()) - np.repeat(np.cumsum(degree) - degree, degree)
+        candidates = neighbours[np.repeat(first[current[active]], degree) + offsets]
+        values = np.einsum("ij,ij->i", directions[pairs], points[candidates])
+        best = np.lexsort((values, pairs))[np.cumsum(degree) - 1]
+        better = values[best] > value[active]
+        active = active[better]
+        current[active] = candidates[best[better]]
+        value[active] = values[best[better]]
+    return value
+
+class BVH:
+    """Bounding volume hierarchy over mesh triangles for any-hit ray queries.
+
+    Nodes are stored as flat arrays in breadth-first order, with the two
+    children of an internal node adjacent. Every node owns the contiguous
+    range order[start:start+size] of triangle indices; leaves have a count
+    equal to their size and internal nodes a count of zero.
+
+    Triangles are grouped by label (connected component, say) before they
+    are split spatially, so each label's triangles form whole subtrees and
+    component gives the label of a node, or -1 for nodes spanning several.
+    The tree is built one level at a time with array operations.
+    """
+    def __init__(self, vertices, faces, labels=None, leaf_size=4):
+        tris = np.asarray(vertices, dtype=float)[np.asarray(faces)].reshape(-1, 3, 3)
+        self.triangles = tris
+        n = len(tris)
+        labels = np.zeros(n, dtype=np.intp) if labels is None else np.asarray(labels)
+        centroids = tris.mean(axis=1)
+
+        order = np.argsort(labels, kind="stable")
+        a, b = np.zeros(1, dtype=np.intp), np.array([n])
+        start, size, left, levels = [], [], [], []
+        while len(a):
+            first = sum(len(s) for s in start)
+            start.append(a); size.append(b); levels.append(first)
+            split = b > leaf_size
+            left.append(np.where(split, first + len(a) + 2*np.cumsum(split) - 2, -1))
+            a, b = a[split], b[split]
+            mid = self._splits(order, labels, centroids, a, b)
+            a, b = np.stack([a, mid], 1).ravel(), np.stack([mid - a, a + b - mid], 1).ravel()
+
+        self.order = order
+        self.start = np.concatenate(start)
+        self.size = np.concatenate(size)
+        self.left = np.concatenate(left)
+        self.right = np.where(self.left >= 0, self.left + 1, -1)
+        self.count = np.where(self.left < 0, self.size, 0)
+
+        # Leaves partition order, so their bounds come from one reduceat;
+        # internal nodes then take the union of their children, level by level.
+        ordered = tris[order]
+        self.lo = np.full((len(self.start), 3), np.inf)
+        self.hi = np.full((len(self.start), 3), -np.inf)
+        label_lo = np.zeros(len(self.start), dtype=np.intp)
+        label_hi = np.zeros(len(self.start), dtype=np.intp)
+        leaves = np.flatnonzero(self.count)
+        leaves = leaves[np.argsort(self.start[leaves])]
+        if n:
+            at = self.start[leaves]
+            self.lo[leaves] = np.minimum.reduceat(ordered.min(axis=1), at)
+            self.hi[leaves] = np.maximum.reduceat(ordered.max(axis=1), at)
+            label_lo[leaves] = np.minimum.reduceat(labels[order], at)
+            label_hi[leaves] = np.maximum.reduceat(labels[order], at)
+        for first, nodes in zip(levels[::-1], start[::-1]):
+            nodes = first + np.flatnonzero(self.left[first:first+len(nodes)] >= 0)
+            l, r = self.left[nodes], self.right[nodes]
+            self.lo[nodes] = np.minimum(self.lo[l], self.lo[r])
+            self.hi[nodes] = np.maximum(self.hi[l], self.hi[r])
+            label_lo[nodes] = np.minimum(label_lo[l], label_lo[r])
+            label_hi[nodes] = np.maximum(label_hi[l], label_hi[r])
+        self.component = np.where(label_lo == label_hi, label_lo, -1)
+        self.labels = labels[order]
+        self.depth = len(levels)
+
+        # Triangle corner and edges in leaf order, so leaves read contiguous rows.
+        self.v0 = ordered[:, 0]
+        self.e1 = ordered[:, 1] - self.v0
+        self.e2 = ordered[:, 2] - self.v0
+
+    @staticmethod
+    def _splits(order, labels, centroids, a, b):
+        """Split point of each range order[a:a+b], reordering order in place.
+
+        Ranges holding several labels split at the label boundary nearest
+        their middle; the others split at the median centroid along their
+        longest axis.
+        """
+        mid = a + b // 2
+        ordered = labels[order]
+        mixed = ordered[a] != ordered[a + b - 1]
+        if np.any(mixed):
+            edges = np.flatnonzero(ordered[1:] != ordered[:-1]) + 1
+            i = np.searchsorted(edges, mid[mixed])
+            below = edges[np.maximum(i - 1, 0)]
+            above = edges[np.minimum(i, len(edges) - 1)]
+            m = mid[mixed]
+            use_below = (below > a[mixed]) & ((above >= a[mixed] + b[mixed]) | (m - below <= above - m))
+            mid[mixed] = np.where(use_below, below, above)
+
+        a, b = a[~mixed], b[~mixed]
+        if len(a):
+            at = np.cumsum(b) - b
+            segment = np.repeat(np.arange(len(a)), b)
+            index = np.repeat(a - at, b) + np.arange(b.sum())
+            c = centroids[order[index]]
+            axis = np.argmax(np.maximum.reduceat(c, at) - np.minimum.reduceat(c, at), axis=1)
+            key = c[np.arange(len(c)), axis[segment]]
+            order[index] = order[index[np.lexsort((key, segment))]]
+        return mid
+
+    def __len__(self): return len(self.triangles)
+
+    def _ray_triangle(self, origins, directions, v0, e1, e2, eps):
+        """Moller-Trumbore test of each ray against its paired triangle."""
+        s = origins - v0
+        p = cross(directions, e2)
+        q = cross(s, e1)
+        det = dot(e1, p)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            inv = 1 / det
+            u = dot(s, p) * inv
+            v = dot(directions, q) * inv
+            t = dot(e2, q) * inv
+            return (np.abs(det) > 1e-15) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > eps)
+
+    def _leaf_pairs(self, rays, nodes):
+        """(ray, slot) pairs of each ray with every triangle of its leaf."""
+        counts = self.count[nodes]
+        pair_rays = np.repeat(rays, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return pair_rays, np.repeat(self.start[nodes], counts) + offsets
+
+    def _boxed(self, nodes, origins, inv_dir, skip):
+        """Slab test of each ray against its node's box, for rays given as
+        (3,R) origins and inverse directions, and the entry distances."""
+        t_near = np.zeros(len(nodes))
+        t_far = np.full(len(nodes), np.inf)
+        for axis in range(3):
+            t1 = (self.lo[nodes, axis] - origins[axis]) * inv_dir[axis]
+            t2 = (self.hi[nodes, axis] - origins[axis]) * inv_dir[axis]
+            t_near = np.maximum(t_near, np.minimum(t1, t2))
+            t_far = np.minimum(t_far, np.maximum(t1, t2))
+        boxed = t_far >= t_near
+        if skip is not None: boxed &= self.component[nodes] != skip
+        return boxed, t_near
+
+    def any_hit(self, origins, directions, ignore=None, skip=None, eps=1e-9):
+        """Whether each ray hits any triangle at a distance beyond eps.
+
+        origins and directions are (R,3) arrays (directions may also be a
+        single (3,) vector). ignore optionally gives, per ray, a triangle
+        index that ray may not hit, typically the facet it starts from,
+        and skip a label whose subtree the ray does not enter (-2 for none).
+
+        Each ray walks the tree depth first with its own stack, entering
+        the nearer of two hit children first, so most rays that hit stop
+        after one descent. All rays take a step together, and the work per
+        step is a handful of array operations over the rays still walking.
+        """
+        origins = np.asarray(origins, dtype=float)
+        directions = np.broadcast_to(np.asarray(directions, dtype=float), origins.shape)
+        safe = np.where(np.abs(directions) < 1e-12, 1e-12, directions)
+        inv_dir = np.ascontiguousarray((1 / safe).T)
+        columns = np.ascontiguousarray(origins.T)
+        if skip is not None: skip = np.asarray(skip)
+
+        hit = np.zeros(len(origins), dtype=bool)
+        stack = np.empty((len(origins), self.depth), dtype=np.int32)
+        top = np.zeros(len(origins), dtype=np.intp)
+        rays = np.flatnonzero(self._boxed(np.zeros(len(origins), dtype=np.intp),
+            columns, inv_dir, skip)[0])
+        nodes = np.zeros(len(rays), dtype=np.intp)
+        while len(rays):
+            leaf = self.count[nodes] > 0
+            if np.any(leaf):
+                pair_rays, slot = self._leaf_pairs(rays[leaf], nodes[leaf])
+                hits = self._ray_triangle(origins[pair_rays], directions[pair_rays],
+                        self.v0[slot], self.e1[slot], self.e2[slot], eps)
+                if ignore is not None:
+                    hits &= self.order[slot] != ignore[pair_rays]
+                hit[pair_rays[hits]] = True
+
+            # Inner nodes step into their nearer hit child and push the other.
+            inner = np.flatnonzero(~leaf)
+            r, l = rays[inner], self.left[nodes[inner]]
+            o, inv = columns.take(r, axis=1), inv_dir.take(r, axis=1)
+            k = None if skip is None else skip.take(r)
+            hit_l, near_l = self._boxed(l, o, inv, k)
+            hit_r, near_r = self._boxed(l + 1, o, inv, k)
+            left_near = near_l <= near_r
+            nodes[inner] = np.where(hit_l & (left_near | ~hit_r), l, l + 1)
+            both = hit_l & hit_r
+            pushed = r[both]
+            stack[pushed, top[pushed]] = np.where(left_near[both], l[both] + 1, l[both])
+            top[pushed] += 1
+
+            # Rays at a leaf or a dead end resume from their stacks.
+            stepped = np.zeros(len(rays), dtype=bool)
+            stepped[inner] = hit_l | hit_r
+            resume = ~stepped & ~hit[rays] & (top[rays] > 0)
+            r = rays[resume]
+            top[r] -= 1
+            nodes[resume] = stack[r, top[r]]
+            walking = stepped | resume
+            rays, nodes = rays[walking], nodes[walking]
+        return hit
+
+class Shadowing:
+    """Illumination and visibility masks of mesh facets by ray casting.
+
+    A facet counts as unoccluded towards a direction when the ray from its
+    centroid along that direction leaves the mesh without hitting another
+    triangle. This is a binary, per-facet test: partly shadowed facets are
+    either fully lit or fully dark. Masks are cached per direction as
+    packed bits, the least recently used dropped beyond cache_bytes.
+
+    Facets whose plane has the whole mesh behind it (every facet of a
+    convex body, and the outer skin of most spacecraft buses) can never be
+    occluded, so rays are only cast from the remaining facets. Facets whose
+    plane has their own connected component behind it (labels, computed
+    from shared vertices by default) cannot be occluded by that component,
+    so their rays skip its subtree of the BVH and are only tested against
+    the other components.
+    """
+    def __init__(self, vertices, faces, normals, cache_bytes=2**25, rays_per_batch=2**18,
+            labels=None):
+        vertices = np.asarray(vertices, dtype=float)
+        faces = np.asarray(faces)
+        if labels is None:
+            from wavefront import component_labels
+            labels = component_labels(faces, len(vertices))
+        self.labels = np.asarray(labels)
+        self.bvh = BVH(vertices, faces, self.labels)
+        self.centroids = vertices[faces].mean(axis=1)
+        self.normals = np.asarray(normals, dtype=float)
+        scale = np.ptp(vertices, axis=0).max() if len(vertices) else 1
+        self.offset = 1e-7 * scale
+        height = np.einsum("ij,ij->i", self.normals, self.centroids) + 1e-9 * scale
+        self.exposed = support(vertices[np.unique(faces)], self.normals) <= height
+        self.component_exposed = self.exposed.copy()
+        order = np.argsort(self.labels, kind="stable")
+        for facets in np.split(order, np.flatnonzero(np.diff(self.labels[order])) + 1):
+            f = facets[~self.exposed[facets]]
+            if len(f) == 0: continue
+            component = vertices[np.unique(faces[facets])]
+            self.component_exposed[f] = support(component, self.normals[f]) <= height[f]
+        self.cache_bytes = cache_bytes
+        self.rays_per_batch = rays_per_batch
+        self._cache = OrderedDict()
+
+    def __len__(self): return len(self.centroids)
+
+    @property
+    def cache_size(self):
+        """Number of masks that fit in cache_bytes."""
+        return max(self.cache_bytes // max(-(-len(self) // 8), 1), 1)
+
+    def subset(self, facets):
+        """Shadowing among the selected facets only."""
+        tris = self.bvh.triangles[facets]
+        faces = np.arange(3*len(tris)).reshape(-1, 3)
+        return Shadowing(tris.reshape(-1, 3), faces, self.normals[facets],
+                self.cache_bytes, self.rays_per_batch, self.labels[facets])
+
+    def _key(self, d): return tuple(np.round(d, 9))
+
+    def _cast(self, directions):
+        """(K,F) unoccluded masks for directions, casting rays only from
+        facets that face each direction."""
+        facing = directions @ self.normals.T > 0
+        k, f = np.nonzero(facing & ~self.exposed)
+        origins = self.centroids[f] + self.offset * self.normals[f]
+        masks = facing & self.exposed
+        skip = np.where(self.component_exposed[f], self.labels[f], -2)
+        masks[k, f] = ~self.bvh.any_hit(origins, directions[k], ignore=f, skip=skip)
+        return masks
+
+    def unoccluded(self, directions):
+        """(..., F) boolean masks for a (..., 3) stack of unit directions."""
+        directions = np.asarray(directions, dtype=float)
+        flat = normalize_rows(directions.reshape(-1, 3))
+        keys = [self._key(d) for d in flat]
+        missing = list(OrderedDict.fromkeys(k for k in keys if k not in self._cache))
+
+        per_batch = max(1, self.rays_per_batch // max(len(self), 1))
+        for i in range(0, len(missing), per_batch):
+            batch = missing[i:i+per_batch]
+            for key, mask in zip(batch, self._cast(np.array(batch))):
+                self._cache[key] = np.packbits(mask)
+
+        masks = np.empty((len(flat), len(self)), dtype=bool)
+        for i, key in enumerate(keys):
+            masks[i] = np.unpackbits(self._cache[key], count=len(self))
+            self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return masks.reshape(directions.shape[:-1] + (len(self),))
+
+    illuminated = unoccluded
+    visible = unoccluded
@@ -17,23 +17,48 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
-import plotly.offline as po
-import plotly.express as px
-import plotly.graph_objs as go
-import numpy as np           
-from geometry import IcoSphere, Rotation
-import pandas as pd
-
-import progressbar as pb
-
-R = Rotation.for_icosphere()
-sphere = IcoSphere.icosahedron().divided(4)
-
-def plot_function_triangles(f, filename):
-    #for t in range(5,10):
-    #sphere = IcoSphere.icosahedron().divided().reduced(t)
-    geo = sphere.geojson
-    vals = sphere.mapf(f)
+from functools import lru_cache
+
+from geometry import IndexedIcoSphere, Rotation
+from instrumentation import stage
+
+# plotly and pandas are imported when a figure is rendered, and spheres are
+# built on first use, so importing this module for its helpers stays cheap.
+
+@lru_cache()
+def sphere(level=4):
+    """Icosphere subdivided level times, built once per level."""
+    with stage("subdivision"):
+        return IndexedIcoSphere.icosahedron().divided(level)
+
+@lru_cache()
+def rotation():
+    return Rotation.for_icosphere()
+
+def plot_function_triangles(f, filename, executor=None, workers=None, level=4,
+        tol=None, max_depth=7, auto_open=True):
+    """Plot f over the faces of an icosphere.
+
+    The sphere is divided level times, or with tol set, refined from there
+    up to max_depth wherever f varies by more than tol across a face (see
+    IndexedIcoSphere.refined).
+    """
+    with stage("subdivision"):
+        s = sphere(level)
+        if tol is not None:
+            s = s.refined(f, tol, max_depth - level, executor, workers)
+    with stage("mapf"):
+        vals = s.mapf(f, executor, workers)
+    plot_sphere_values(s, vals, filename, auto_open)
+
+def plot_sphere_values(s, vals, filename, auto_open=True):
+    """Write a choropleth of one value per face of IndexedIcoSphere s."""
+    import plotly.offline as po
+    import plotly.express as px
+    import pandas as pd
+
+    with stage("geojson"):
+        geo = s.geojson
     ids = range(len(vals))
     dat = {'ids':ids, 'vals':vals}
     df = pd.DataFrame(data=dat)
@@ -48,13 +73,18 @@ def plot_function_triangles(f, filename):
     fig.data[0].marker.line.width = 0
     configure_fig(fig)
 
-    po.plot(fig, filename=filename)
+    with stage("html"):
+        po.plot(fig, filename=filename, auto_open=auto_open)
 
-def plot_function_points(f):
-    lats = sphere.bary_lats
-    lons = sphere.bary_lons
-    print("hello")
-    vals = sphere.mapf(f)
+def plot_function_points(f, executor=None, workers=None, level=4):
+    import plotly.offline as po
+    import plotly.express as px
+
+    s = sphere(level)
+    lats = s.bary_lats
+    lons = s.bary_lons
+    with stage("mapf"):
+        vals = s.mapf(f, executor, workers)
 
     fig = px.scatter_geo(lat=lats, lon=lons, color=vals,)
 
@@ -62,8 +92,12 @@ def plot_function_points(f):
 
     po.plot(fig, filename="points.html")
 
-def plot_sphere_points():
-    fig = px.scatter_geo(lat=lats, lon=lons)
+def plot_sphere_points(level=4):
+    import plotly.offline as po
+    import plotly.express as px
+
+    s = sphere(level)
+    fig = px.scatter_geo(lat=s.bary_lats, lon=s.bary_lons)
     po.plot(fig, filename="points.html")
 
 def configure_fig(fig):
@@ -119,4 +153,4 @@ def configure_fig(fig):
 if __name__ == "__main__":
     """Test this module on a simple function."""
     def f(p): return p.x
-    plot_function_triangles(f)
+    plot_function_triangles(f, "test.html")
@@ -0,0 +1,297 @@
+'''
+photometry.py. Visualize the photometric output of a Wavefront obj. model.
+Copyright (C) 2020  Drew Allen McNeely
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import re
+import numpy as np
+from itertools import islice
+from pathlib import Path
+
+
+from geometry import normalize_rows
+
+def component_labels(faces, vertex_count):
+    """Connected component of each face, numbered 0..n-1 in order of first face.
+
+    Faces are connected when they share a vertex; the components come
+    from one sparse-graph pass over the face edges.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    faces = np.asarray(faces)
+    if len(faces) == 0: return np.zeros(0, dtype=np.intp)
+    a = faces.ravel()
+    b = np.roll(faces, -1, axis=1).ravel()
+    graph = coo_matrix((np.ones(len(a), dtype=np.int8), (a, b)),
+            shape=(vertex_count, vertex_count))
+    _, vertex_labels = connected_components(graph, directed=False)
+    labels = vertex_labels[faces[:, 0]]
+    _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=np.intp)
+    rank[np.argsort(first)] = np.arange(len(first))
+    return rank[inverse.ravel()]
+
+class ObjMesh:
+    """Triangle mesh read from a Wavefront .obj file.
+
+    It answers the parts of the pymesh Mesh interface the models use
+    (vertices, faces, add_attribute/get_attribute of face_area and
+    face_normal), so it can be passed wherever a pymesh mesh is expected.
+    face_material indexes material_names, with -1 for faces that come
+    before any usemtl statement, and materials holds the parsed .mtl
+    entries by name.
+    """
+    # Type the face attributes are computed in; see compact.
+    attribute_dtype = np.dtype(float)
+    # Faces whose attributes are computed at once.
+    attribute_chunk = 1 << 16
+
+    def __init__(self, vertices, faces, face_material=None, material_names=(), materials=None):
+        self.vertices = np.ascontiguousarray(vertices, dtype=float).reshape(-1, 3)
+        self.faces = np.ascontiguousarray(faces, dtype=np.intp).reshape(-1, 3)
+        if face_material is None: face_material = np.zeros(len(self.faces), dtype=np.intp)
+        self.face_material = np.asarray(face_material, dtype=np.intp)
+        self.material_names = list(material_names)
+        self.materials = materials or {}
+        self._attributes = {}
+        self._component_labels = None
+
+    @classmethod
+    def from_arrays(cls, arrays, metadata):
+        """Rebuild from the output of to_arrays, keeping the arrays as given."""
+        mesh = cls.__new__(cls)
+        mesh.vertices = arrays["vertices"]
+        mesh.faces = arrays["faces"]
+        mesh.face_material = arrays["face_material"]
+        mesh.material_names = metadata["material_names"]
+        mesh.materials = metadata["materials"]
+        mesh._attributes = {
+                "face_area": arrays["face_area"],
+                "face_normal": arrays["face_normal"]}
+        mesh._component_labels = arrays["component_labels"]
+        return mesh
+
+    def to_arrays(self):
+        """Arrays and JSON metadata describing the mesh and its face attributes."""
+        arrays = {
+                "vertices": self.vertices,
+                "faces": self.faces,
+                "face_material": self.face_material,
+                "face_area": self.get_attribute("face_area"),
+                "face_normal": self.get_attribute("face_normal"),
+                "component_labels": self.component_labels}
+        metadata = {
+                "material_names": self.material_names,
+                "materials": self.materials}
+        return arrays, metadata
+
+    @classmethod
+    def from_mesh(cls, mesh):
+        """Copy of a pymesh mesh, including its face area and normal attributes."""
+        for a in ["face_area", "face_normal"]:
+            mesh.add_attribute(a)
+        copy = cls(mesh.vertices, mesh.faces)
+        copy._attributes = {a: mesh.get_attribute(a) for a in ["face_area", "face_normal"]}
+        return copy
+
+    @property
+    def component_labels(self):
+        if self._component_labels is None:
+            self._component_labels = component_labels(self.faces, len(self.vertices))
+        return self._component_labels
+
+    @property
+    def num_vertices(self): return len(self.vertices)
+    @property
+    def num_faces(self): return len(self.faces)
+
+    @property
+    def face_cross_products(self):
+        tri = self.vertices[self.faces]
+        return np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+
+    def add_attribute(self, name):
+        if name in self._attributes: return
+        elif name == "face_area" or name == "face_normal":
+            # Chunked, so that only the attributes themselves are held at
+            # full size; each chunk is computed in double precision.
+            area = np.empty(len(self.faces), dtype=self.attribute_dtype)
+            normal = np.empty((len(self.faces), 3), dtype=self.attribute_dtype)
+            for i in range(0, len(self.faces), self.attribute_chunk):
+                tri = self.vertices[self.faces[i:i+self.attribute_chunk]]
+                c = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+                area[i:i+len(c)] = np.linalg.norm(c, axis=1) / 2
+                normal[i:i+len(c)] = normalize_rows(c)
+            self._attributes["face_area"] = area
+            self._attributes["face_normal"] = normal.ravel()
+        else: raise KeyError("unsupported attribute " + repr(name))
+
+    def clear_attributes(self):
+        """Drop the cached face attributes; they are recomputed when next asked for."""
+        self._attributes = {}
+
+    def compact(self, dtype=np.float32):
+        """Store faces as int32 and face materials as int16 when they fit,
+        and keep face attributes, cached or computed later, as dtype."""
+        if len(self.vertices) < 2**31:
+            self.faces = self.faces.astype(np.int32, copy=False)
+        if len(self.material_names) < 2**15:
+            self.face_material = self.face_material.astype(np.int16, copy=False)
+        if self._component_labels is not None and len(self.faces) < 2**31:
+            self._component_labels = self._component_labels.astype(np.int32, copy=False)
+        self.attribute_dtype = np.dtype(dtype)
+        self._attributes = {name: a.astype(dtype, copy=False) for name, a in self._attributes.items()}
+
+    def get_attribute(self, name):
+        self.add_attribute(name)
+        return self._attributes[name]
+
+def _parse_value(tokens):
+    try: values = [float(t) for t in tokens]
+    except ValueError: return " ".join(tokens)
+    return values[0] if len(values) == 1 else tuple(values)
+
+def load_mtl(path):
+    """Materials of a .mtl file as {name: {statement: value}}.
+
+    Numeric statements become floats or tuples of floats (Kd, Ks, Ns, ...),
+    anything else is kept as a string.
+    """
+    materials = {}
+    current = None
+    with open(path) as f:
+        for line in f:
+            tokens = line.split()
+            if not tokens or tokens[0].startswith("#"): continue
+            if tokens[0] == "newmtl":
+                current = materials.setdefault(" ".join(tokens[1:]), {})
+            elif current is not None:
+                current[tokens[0]] = _parse_value(tokens[1:])
+    return materials
+
+_mtllib = re.compile(rb"^mtllib[ \t]+(.*?)\s*$", re.MULTILINE)
+
+def material_libraries(path, block_size=1 << 20):
+    """Paths of the .mtl files named by the mtllib statements of an .obj
+    file, found by a regular expression over its bytes rather than by
+    parsing it."""
+    path = Path(path)
+    names = []
+    tail = b""
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            block = tail + block
+            cut = block.rfind(b"\n") + 1
+            names += _mtllib.findall(block[:cut])
+            tail = block[cut:]
+    names += _mtllib.findall(tail)
+    return [path.parent / n.decode() for n in names]
+
+def _triangulate(indices, counts):
+    """Fan-triangulate polygons given as flat vertex indices and sizes."""
+    starts = np.cumsum(counts) - counts
+    tris = np.maximum(counts - 2, 0)
+    first = np.repeat(starts, tris)
+    k = np.arange(tris.sum()) - np.repeat(np.cumsum(tris) - tris, tris)
+    return np.stack([indices[first], indices[first + k + 1], indices[first + k + 2]], axis=-1)
+
+def load_obj(path, load_materials=True, lines_per_chunk=1 << 17):
+    """Read vertices, faces and materials of a Wavefront .obj file.
+
+    The file is streamed lines_per_chunk lines at a time; each chunk's
+    vertex and face statements are converted to arrays in bulk, so memory
+    stays close to the size of the final arrays. Polygons are fan
+    triangulated, texture and normal indices are ignored, and negative
+    (relative) vertex indices are resolved; a ValueError naming the line
+    is raised for indices outside the vertices. Statements may be
+    separated by any whitespace. The companion .mtl files named
+    by mtllib statements are parsed when load_materials is set.
+    """
+    path = Path(path)
+    vertex_chunks, face_chunks, material_chunks = [], [], []
+    material_names = []
+    mtllibs = []
+    vertex_count = 0
+    line_count = 0
+    material = -1
+    # Largest positive vertex index and its line, checked once all
+    # vertices are known.
+    furthest = (0, 0)
+
+    def out_of_range(index, line):
+        return ValueError("%s:%d: vertex index %d is out of range" % (path, line, index))
+
+    with open(path) as f:
+        while True:
+            lines = list(islice(f, lines_per_chunk))
+            if not lines: break
+
+            coords = []
+            indices = []
+            counts = []
+            offsets = []
+            face_lines = []
+            face_material = []
+            for number, line in enumerate(lines, line_count + 1):
+                tokens = line.split()
+                if not tokens: continue
+                key = tokens[0]
+                if key == "v":
+                    coords.append(tokens[1:4])
+                elif key == "f":
+                    indices += [t.partition("/")[0] for t in tokens[1:]]
+                    counts.append(len(tokens) - 1)
+                    offsets.append(vertex_count + len(coords))
+                    face_lines.append(number)
+                    face_material.append(material)
+                elif key == "usemtl":
+                    name = line.split(None, 1)[1].strip() if len(tokens) > 1 else ""
+                    if name not in material_names: material_names.append(name)
+                    material = material_names.index(name)
+                elif key == "mtllib":
+                    mtllibs.append(line.split(None, 1)[1].strip() if len(tokens) > 1 else "")
+            line_count += len(lines)
+
+            if coords:
+                vertex_chunks.append(np.array(coords, dtype=float))
+            if counts:
+                raw = np.array(indices, dtype=np.intp)
+                counts = np.array(counts)
+                base = np.repeat(np.array(offsets), counts)
+                idx = np.where(raw < 0, base + raw, raw - 1)
+                if np.any(idx < 0):
+                    i = np.argmax(idx < 0)
+                    raise out_of_range(raw[i], np.repeat(face_lines, counts)[i])
+                i = np.argmax(raw)
+                if raw[i] > furthest[0]: furthest = (raw[i], np.repeat(face_lines, counts)[i])
+                face_chunks.append(_triangulate(idx, counts))
+                material_chunks.append(np.repeat(np.array(face_material), np.maximum(counts - 2, 0)))
+            vertex_count += len(coords)
+
+    if furthest[0] > vertex_count: raise out_of_range(*furthest)
+    vertices = np.concatenate(vertex_chunks) if vertex_chunks else np.empty((0, 3))
+    faces = np.concatenate(face_chunks) if face_chunks else np.empty((0, 3), dtype=np.intp)
+    face_material = np.concatenate(material_chunks) if material_chunks else None
+
+    materials = {}
+    if load_materials:
+        for lib in mtllibs:
+            mtl = path.parent / lib
+            if mtl.exists(): materials.update(load_mtl(mtl))
+    return ObjMesh(vertices, faces, face_material, material_names, materials)